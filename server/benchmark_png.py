@@ -0,0 +1,78 @@
+"""Benchmarks the .png settings used when importing images.
+
+Usage: python benchmark_png.py <image dir> [--workers N]
+
+For each compress_level (and optimize), encodes every image in the directory across a pool
+of processes, the same way an import does, and reports the encoding speed (MB/s of RGB
+pixels) and the total size on disk.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from consts import IMPORT_WORKERS
+from image import valid_images_for_import
+from PIL import Image
+
+SETTINGS = [(level, False) for level in range(10)] + [(9, True)]
+
+
+def encode(
+    img_path: str, output_path: str, compress_level: int, optimize: bool
+) -> tuple[int, float, int]:
+    # Returns (RGB bytes, seconds spent encoding, bytes on disk).
+    with Image.open(img_path) as img:
+        rgb = img.convert("RGB")
+        rgb.load()
+    start = time.perf_counter()
+    rgb.save(output_path, "PNG", compress_level=compress_level, optimize=optimize)
+    elapsed = time.perf_counter() - start
+    return rgb.width * rgb.height * 3, elapsed, os.path.getsize(output_path)
+
+
+def benchmark(from_path: str, workers: int):
+    img_paths = [os.path.join(from_path, f) for f in valid_images_for_import(from_path)]
+    if not img_paths:
+        print(f"No images found in {from_path}")
+        return
+
+    print(f"{len(img_paths)} images, {workers} workers")
+    print(
+        f"{'level':>5} {'optimize':>8} {'MB/s/core':>10} {'MB/s':>8} {'wall (s)':>9} {'MB on disk':>11}"
+    )
+    with tempfile.TemporaryDirectory() as output_dir, ProcessPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        output_paths = [
+            os.path.join(output_dir, f"{i}.png") for i in range(len(img_paths))
+        ]
+        for compress_level, optimize in SETTINGS:
+            start = time.perf_counter()
+            results = list(
+                executor.map(
+                    partial(encode, compress_level=compress_level, optimize=optimize),
+                    img_paths,
+                    output_paths,
+                )
+            )
+            wall = time.perf_counter() - start
+
+            rgb_mb = sum(r[0] for r in results) / 1e6
+            encode_secs = sum(r[1] for r in results)
+            disk_mb = sum(r[2] for r in results) / 1e6
+            print(
+                f"{compress_level:>5} {str(optimize):>8} {rgb_mb / encode_secs:>10.1f} "
+                f"{rgb_mb / wall:>8.1f} {wall:>9.2f} {disk_mb:>11.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("from_path")
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS)
+    args = parser.parse_args()
+    benchmark(args.from_path, args.workers)
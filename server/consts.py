@@ -7,5 +7,24 @@ AUTO_TAGS = "auto_tags"
 PROJECT_CATEGORY_FILE = "categories.json"
 DEFAULT_CATEGORY_FILE = "default_categories.json"
 PROJECT_CONFIG_FILE = "config.json"
+MANIFEST_FILE = "manifest.db"
 SUPPORTED_IMG_EXTS = ["png", "jpg", "jpeg", "gif", "bmp", "webp", "avif"]
 LOWERCASE_IS_TRUE = ["true", "1", "yes", "t", "y", True]
+MAX_CACHED_PROJECTS = 8
+THUMBS_DIR = ".thumbs"
+THUMBNAIL_WIDTH = 250
+THUMBNAIL_WORKERS = 2
+IMPORT_WORKERS = os.cpu_count() or 1
+PNG_COMPRESS_LEVEL = 6  # 0 (fastest, largest) to 9 (slowest, smallest)
+WRITE_BEHIND_DELAY_SECS = 0.5  # How long to coalesce config writes for
+IMAGES_PAGE_SIZE = 100
+MAX_IMAGES_PAGE_SIZE = 1000
+JOB_WORKERS = 2  # Imports that can run at once
+MAX_FINISHED_JOBS = 50
+SSE_KEEPALIVE_SECS = 15
+PREVIEW_MAX_DIM = 1024  # Small rotate previews are made from a copy this size
+PREVIEW_CACHE_SIZE = 64
+DERIVATIVES_DIR = ".derivatives"
+DERIVATIVE_SIZES = [128, 250, 512, 1024]
+DERIVATIVE_QUALITY = 80
+TAG_READ_WORKERS = 8
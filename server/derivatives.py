@@ -0,0 +1,64 @@
+import os
+import threading
+from pathlib import Path
+
+import pillow_avif  # type: ignore
+from consts import DERIVATIVE_QUALITY, DERIVATIVE_SIZES
+from PIL import Image
+from thumbnails import is_fresh
+
+# Extension -> (Pillow format, mimetype), smallest files first.
+FORMATS = {
+    "avif": ("AVIF", "image/avif"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+
+def choose_format(accept: str) -> str:
+    # The extension of the smallest format the browser accepts (they all take JPEG).
+    for ext, (_, mimetype) in FORMATS.items():
+        if mimetype in accept:
+            return ext
+    return "jpeg"
+
+
+def derivative_etag(img_path: Path, size: int, ext: str) -> str:
+    # Derivatives are only regenerated when the image changes, so this identifies the bytes.
+    return f"{img_path.stem}-{os.stat(img_path).st_mtime_ns}-{size}.{ext}"
+
+
+def make_derivative(img_path: Path, derivatives_dir: Path, size: int, ext: str) -> Path:
+    """Make Derivative.
+
+    Returns the path to a copy of the image that fits in size x size pixels, in the format
+    for ext, generating it first if it's missing or older than the image.
+    """
+    if size not in DERIVATIVE_SIZES:
+        raise ValueError(f"Unsupported size: {size}")
+    derivative_path = derivatives_dir.joinpath(str(size), f"{img_path.stem}.{ext}")
+    if is_fresh(img_path, derivative_path):
+        return derivative_path
+
+    os.makedirs(derivative_path.parent, exist_ok=True)
+    with Image.open(img_path) as img:
+        img.thumbnail((size, size))
+        if ext == "jpeg" or img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGB")
+
+        # Write to a temp file first, so we never serve a half-written file.
+        tmp_path = derivative_path.with_name(
+            f".{derivative_path.name}.{threading.get_ident()}.tmp"
+        )
+        img.save(tmp_path, FORMATS[ext][0], quality=DERIVATIVE_QUALITY)
+    os.replace(tmp_path, derivative_path)
+    return derivative_path
+
+
+def delete_derivatives(fname: str, derivatives_dir: Path):
+    stem = Path(fname).stem
+    for size in DERIVATIVE_SIZES:
+        for ext in FORMATS:
+            derivative_path = derivatives_dir.joinpath(str(size), f"{stem}.{ext}")
+            if os.path.exists(derivative_path):
+                os.remove(derivative_path)
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from derivatives import choose_format, delete_derivatives, make_derivative
+from PIL import Image
+
+
+class TestDerivatives(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.img_path = Path(self.temp_dir.name).joinpath("test.png")
+        self.derivatives_dir = Path(self.temp_dir.name).joinpath(".derivatives")
+        Image.new("RGBA", (1000, 500), color="red").save(self.img_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_choose_format(self):
+        self.assertEqual(choose_format("image/avif,image/webp,*/*"), "avif")
+        self.assertEqual(choose_format("image/webp,*/*"), "webp")
+        self.assertEqual(choose_format("*/*"), "jpeg")
+
+    def test_make_derivative(self):
+        for ext, format in [("webp", "WEBP"), ("jpeg", "JPEG"), ("avif", "AVIF")]:
+            path = make_derivative(self.img_path, self.derivatives_dir, 512, ext)
+            with Image.open(path) as img:
+                self.assertEqual(img.format, format)
+                self.assertEqual(img.size, (512, 256))
+
+        # Only generated once.
+        mtime = os.stat(path).st_mtime_ns
+        make_derivative(self.img_path, self.derivatives_dir, 512, "avif")
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+
+        with self.assertRaises(ValueError):
+            make_derivative(self.img_path, self.derivatives_dir, 100, "webp")
+
+        delete_derivatives("test.png", self.derivatives_dir)
+        self.assertEqual(os.listdir(self.derivatives_dir.joinpath("512")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+
+from consts import WRITE_BEHIND_DELAY_SECS
+
+
+def write_atomically(path: str | os.PathLike, contents: str):
+    # Write to a temp file first, so readers never see a half written file.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w") as fp:
+            fp.write(contents)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class WriteBehindFile:
+    """A file that's written in the background.
+
+    write() keeps the new contents in memory and returns straight away. They're written to
+    disk (atomically) after delay seconds, so a burst of writes only touches the disk once.
+    read() returns the latest contents, whether or not they've been written yet.
+    """
+
+    def __init__(self, path: str | os.PathLike, delay: float):
+        self.path = path
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending: str | None = None
+        self._timer: threading.Timer | None = None
+
+    def read(self) -> str | None:
+        with self._lock:
+            if self._pending is not None:
+                return self._pending
+            if not os.path.exists(self.path):
+                return None
+            with open(self.path, "r") as fp:
+                return fp.read()
+
+    def write(self, contents: str):
+        with self._lock:
+            self._pending = contents
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        # Hold the lock while writing, so read() never sees an older copy on disk.
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pending is not None:
+                write_atomically(self.path, self._pending)
+                self._pending = None
+
+
+_write_behind_files: dict[str, WriteBehindFile] = {}
+_write_behind_files_lock = threading.Lock()
+
+
+def write_behind_file(
+    path: str | os.PathLike, delay: float = WRITE_BEHIND_DELAY_SECS
+) -> WriteBehindFile:
+    # Everyone writing the same file shares a WriteBehindFile, so they all see the latest
+    # contents.
+    key = os.path.abspath(path)
+    with _write_behind_files_lock:
+        if key not in _write_behind_files:
+            _write_behind_files[key] = WriteBehindFile(path, delay)
+        return _write_behind_files[key]
+
+
+@atexit.register
+def flush_all():
+    with _write_behind_files_lock:
+        files = list(_write_behind_files.values())
+    for f in files:
+        f.flush()
+
+
+class RWLock:
+    """A lock that any number of readers can hold at once, or a single writer.
+
+    Waiting writers go first, so a steady stream of readers can't starve them. Both sides
+    are reentrant, and the writer can also read, but a reader can't become a writer.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers: dict[int, int] = {}
+        self._writer: int | None = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me and me not in self._readers:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers[me] -= 1
+                if self._readers[me] == 0:
+                    del self._readers[me]
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                if me in self._readers:
+                    raise RuntimeError("Can't write while holding a read lock")
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if self._writer_depth == 0:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+_dir_locks: dict[str, RWLock] = {}
+_dir_locks_lock = threading.Lock()
+
+
+def dir_lock(path: str | os.PathLike) -> RWLock:
+    # One lock per directory, shared by everyone using it.
+    key = os.path.abspath(path)
+    with _dir_locks_lock:
+        if key not in _dir_locks:
+            _dir_locks[key] = RWLock()
+        return _dir_locks[key]
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from files import RWLock, WriteBehindFile, dir_lock, write_atomically
+
+
+class TestWriteAtomically(unittest.TestCase):
+    def test_write_atomically(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "test.txt")
+            write_atomically(path, "first")
+            write_atomically(path, "second")
+            with open(path, "r") as fp:
+                self.assertEqual(fp.read(), "second")
+            self.assertEqual(os.listdir(temp_dir), ["test.txt"])
+
+
+class TestWriteBehindFile(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, "test.json")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_coalesces_writes(self):
+        f = WriteBehindFile(self.path, delay=60)
+        self.assertIsNone(f.read())
+
+        f.write("first")
+        f.write("second")
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(f.read(), "second")
+
+        f.flush()
+        with open(self.path, "r") as fp:
+            self.assertEqual(fp.read(), "second")
+        self.assertEqual(f.read(), "second")
+
+    def test_writes_after_delay(self):
+        f = WriteBehindFile(self.path, delay=0.01)
+        f.write("contents")
+        f._timer.join()
+        with open(self.path, "r") as fp:
+            self.assertEqual(fp.read(), "contents")
+
+
+class TestRWLock(unittest.TestCase):
+    def test_readers_share(self):
+        lock = RWLock()
+        both_reading = threading.Barrier(2, timeout=5)
+
+        def read():
+            with lock.read():
+                both_reading.wait()
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        read()
+        thread.join()
+
+    def test_writer_excludes_readers(self):
+        lock = RWLock()
+        read = threading.Event()
+
+        def read_lock():
+            with lock.read():
+                read.set()
+
+        with lock.write():
+            thread = threading.Thread(target=read_lock)
+            thread.start()
+            self.assertFalse(read.wait(0.05))
+        self.assertTrue(read.wait(5))
+        thread.join()
+
+    def test_reentrant(self):
+        lock = RWLock()
+        with lock.write(), lock.write(), lock.read():
+            pass
+        with lock.read(), lock.read():
+            with self.assertRaises(RuntimeError):
+                with lock.write():
+                    pass
+
+    def test_dir_lock(self):
+        self.assertIs(dir_lock("projects/a"), dir_lock("projects/../projects/a"))
+        self.assertIsNot(dir_lock("projects/a"), dir_lock("projects/b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
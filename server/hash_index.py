@@ -0,0 +1,57 @@
+from typing import Any
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """Image hashes indexed by Hamming distance.
+
+    A BK-tree: each node's children are keyed by their distance to the node, so a search
+    can skip any subtree that can't be within range (triangle inequality). This makes
+    finding near duplicates much cheaper than comparing against every image.
+    """
+
+    def __init__(self):
+        # Nodes are [hash, values, children].
+        self._root: list | None = None
+        self._size = 0
+
+    def add(self, hash: int, value: Any):
+        self._size += 1
+        if self._root is None:
+            self._root = [hash, [value], {}]
+            return
+
+        node = self._root
+        while True:
+            distance = hamming_distance(hash, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash, [value], {}]
+                return
+            node = child
+
+    def find(self, hash: int, max_distance: int = 0) -> list[tuple[int, Any]]:
+        """Returns (distance, value) for every value within max_distance of hash."""
+        results = []
+        if self._root is None:
+            return results
+
+        to_visit = [self._root]
+        while to_visit:
+            node = to_visit.pop()
+            distance = hamming_distance(hash, node[0])
+            if distance <= max_distance:
+                results.extend((distance, value) for value in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    to_visit.append(child)
+        return results
+
+    def __len__(self) -> int:
+        return self._size
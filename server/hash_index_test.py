@@ -0,0 +1,54 @@
+import random
+import unittest
+
+from hash_index import HashIndex, hamming_distance
+
+
+class TestHashIndex(unittest.TestCase):
+    def test_hamming_distance(self):
+        self.assertEqual(hamming_distance(0b1010, 0b1010), 0)
+        self.assertEqual(hamming_distance(0b1010, 0b0101), 4)
+        self.assertEqual(hamming_distance(0, 0xFFFFFFFFFFFFFFFF), 64)
+
+    def test_find_exact(self):
+        index = HashIndex()
+        index.add(0xFF00, "a")
+        index.add(0xFF00, "b")
+        index.add(0xFF01, "c")
+
+        self.assertEqual(len(index), 3)
+        self.assertEqual(sorted(index.find(0xFF00)), [(0, "a"), (0, "b")])
+        self.assertEqual(index.find(0x1234), [])
+        self.assertEqual(HashIndex().find(0xFF00), [])
+
+    def test_find_near_duplicates(self):
+        index = HashIndex()
+        index.add(0b0000, "zero")
+        index.add(0b0001, "one bit")
+        index.add(0b0011, "two bits")
+        index.add(0b1111, "four bits")
+
+        self.assertEqual(
+            sorted(index.find(0b0000, max_distance=2)),
+            [(0, "zero"), (1, "one bit"), (2, "two bits")],
+        )
+
+    def test_same_as_brute_force(self):
+        rng = random.Random(42)
+        hashes = [rng.getrandbits(16) for _ in range(500)]
+        index = HashIndex()
+        for i, hash in enumerate(hashes):
+            index.add(hash, i)
+
+        for _ in range(20):
+            query = rng.getrandbits(16)
+            expected = sorted(
+                (hamming_distance(query, hash), i)
+                for i, hash in enumerate(hashes)
+                if hamming_distance(query, hash) <= 4
+            )
+            self.assertEqual(sorted(index.find(query, max_distance=4)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,10 @@
 import os
+import threading
 from pathlib import Path
 
-from consts import IMG_EXT, SUPPORTED_IMG_EXTS
+import imagehash
+from consts import IMG_EXT, PNG_COMPRESS_LEVEL, SUPPORTED_IMG_EXTS
+from PIL import Image
 
 
 class Crop:
@@ -39,19 +42,62 @@ def valid_import_directory(from_path: str) -> bool:
     return True
 
 
+def make_image_filename(file_prefix: str, i: int) -> str:
+    return f"{file_prefix}_{i}.{IMG_EXT}"
+
+
+class FilenameIndex:
+    """The filenames taken in an image directory.
+
+    Built from one directory listing, then kept up to date as files are added and removed,
+    so choosing a free filename doesn't need to check the disk for every candidate.
+    """
+
+    def __init__(self, img_dir_path: Path | str):
+        self._names = (
+            set(os.listdir(img_dir_path)) if os.path.isdir(img_dir_path) else set()
+        )
+        self._lock = threading.Lock()
+
+    def __contains__(self, fname: str) -> bool:
+        return fname in self._names
+
+    def add(self, fname: str):
+        with self._lock:
+            self._names.add(fname)
+
+    def discard(self, fname: str):
+        with self._lock:
+            self._names.discard(fname)
+
+    def allocate(self, file_prefix: str, i=0) -> str:
+        # Reserves the first free {file_prefix}_{i} filename, starting from i.
+        with self._lock:
+            fname = make_image_filename(file_prefix, i)
+            while fname in self._names:
+                i += 1
+                fname = make_image_filename(file_prefix, i)
+            self._names.add(fname)
+            return fname
+
+
 def choose_image_filename(
-    img_dir_path: Path, file_prefix: str, i=0, remove_duplicates=True
+    img_dir_path: Path,
+    file_prefix: str,
+    i=0,
+    remove_duplicates=True,
+    index: FilenameIndex | None = None,
 ) -> str:
-    def make_fname(file_prefix, i):
-        return f"{file_prefix}_{i}.{IMG_EXT}"
-
-    fname = make_fname(file_prefix, i)
+    fname = make_image_filename(file_prefix, i)
     if remove_duplicates:
         return fname
 
+    if index is not None:
+        return index.allocate(file_prefix, i)
+
     while os.path.exists(os.path.join(img_dir_path, fname)):
         i += 1
-        fname = make_fname(file_prefix, i)
+        fname = make_image_filename(file_prefix, i)
 
     return fname
 
@@ -63,3 +109,39 @@ def get_image_i(filename: str) -> int:
         return int(Path(filename).stem.split("_")[-1])
     except ValueError:
         return 0
+
+
+def parse_image_filename(filename: str) -> tuple[str, int, int] | None:
+    # Extract (hash, w, h) from
+    # {hash}_{w}x{h}_{i}.{ext}
+    parts = Path(filename).stem.split("_")
+    if len(parts) != 3:
+        return None
+    try:
+        width, height = (int(x) for x in parts[1].split("x"))
+        int(parts[0], 16)
+    except ValueError:
+        return None
+    return parts[0], width, height
+
+
+def convert_for_import(
+    img_path: str,
+    output_path: str,
+    compress_level: int = PNG_COMPRESS_LEVEL,
+    optimize: bool = False,
+) -> tuple[str, int, int]:
+    """Convert for Import.
+
+    Hashes the image and saves it as a .png, only decoding it once. Returns (hash, w, h).
+    Runs in a worker process during imports.
+
+    compress_level is zlib's 0-9. optimize makes the smallest file possible, but is much
+    slower and ignores compress_level.
+    """
+    with Image.open(img_path) as img:
+        hash = str(imagehash.average_hash(img))
+        img.convert("RGB").save(
+            output_path, "PNG", compress_level=compress_level, optimize=optimize
+        )
+        return hash, img.width, img.height
@@ -3,11 +3,15 @@ import tempfile
 import unittest
 
 from image import (
+    FilenameIndex,
     choose_image_filename,
+    convert_for_import,
     is_supported_image,
+    parse_image_filename,
     valid_images_for_import,
     valid_import_directory,
 )
+from PIL import Image
 
 
 class TestImageFunctions(unittest.TestCase):
@@ -56,6 +60,49 @@ class TestImageFunctions(unittest.TestCase):
         filename = choose_image_filename(self.temp_dir_path, "prefix", 0, False)
         self.assertEqual(filename, "prefix_1.png")
 
+    def test_filename_index(self):
+        open(os.path.join(self.temp_dir_path, "prefix_0.png"), "w").close()
+        open(os.path.join(self.temp_dir_path, "prefix_1.png"), "w").close()
+        index = FilenameIndex(self.temp_dir_path)
+        self.assertIn("prefix_0.png", index)
+
+        # Allocated filenames are reserved.
+        self.assertEqual(index.allocate("prefix"), "prefix_2.png")
+        self.assertEqual(index.allocate("prefix"), "prefix_3.png")
+        self.assertEqual(index.allocate("prefix", 10), "prefix_10.png")
+
+        index.discard("prefix_0.png")
+        self.assertEqual(index.allocate("prefix"), "prefix_0.png")
+
+        # Same as checking the disk.
+        index = FilenameIndex(self.temp_dir_path)
+        self.assertEqual(
+            choose_image_filename(self.temp_dir_path, "prefix", 0, False, index),
+            choose_image_filename(self.temp_dir_path, "prefix", 0, False),
+        )
+
+        # Missing directory.
+        self.assertEqual(FilenameIndex("fake/path").allocate("prefix"), "prefix_0.png")
+
+    def test_parse_image_filename(self):
+        self.assertEqual(
+            parse_image_filename("ff00ff00ff00ff00_60x30_2.png"),
+            ("ff00ff00ff00ff00", 60, 30),
+        )
+        self.assertIsNone(parse_image_filename("test.png"))
+        self.assertIsNone(parse_image_filename("ff00_sixtyx30_0.png"))
+        self.assertIsNone(parse_image_filename("not-hex_60x30_0.png"))
+
+    def test_convert_for_import(self):
+        img_path = os.path.join(self.temp_dir_path, "real.webp")
+        output_path = os.path.join(self.temp_dir_path, "output.png")
+        Image.new("RGBA", (60, 30), color="white").save(img_path)
+        self.assertEqual(
+            convert_for_import(img_path, output_path), ("0000000000000000", 60, 30)
+        )
+        with Image.open(output_path) as img:
+            self.assertEqual((img.format, img.mode, img.size), ("PNG", "RGB", (60, 30)))
+
 
 if __name__ == "__main__":
     unittest.main()
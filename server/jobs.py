@@ -0,0 +1,127 @@
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+from consts import JOB_WORKERS, MAX_FINISHED_JOBS
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobConflict(Exception):
+    """An unfinished job with the same key was submitted with different arguments."""
+
+    def __init__(self, job: "Job"):
+        super().__init__(f"Job {job.id} is already running")
+        self.job = job
+
+
+class Job:
+    """A long running task, i.e. an import, that yields progress updates.
+
+    Each update replaces the last, and is numbered, so anyone watching can pick up where
+    they left off (or just get the latest) with wait().
+    """
+
+    def __init__(self, key: str, args: dict | None = None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.args = args or {}
+        self.status = QUEUED
+        self.error = ""
+        self.seq = 0
+        self.progress: dict = {}
+        self._cond = threading.Condition()
+
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def update(self, progress: dict):
+        with self._cond:
+            self.seq += 1
+            self.progress = progress
+            self._cond.notify_all()
+
+    def set_status(self, status: str, error: str = ""):
+        with self._cond:
+            self.status = status
+            self.error = error
+            self._cond.notify_all()
+
+    def wait(self, after_seq: int, timeout: float | None = None) -> tuple[int, dict]:
+        # Waits for an update newer than after_seq, and returns (seq, progress). If there
+        # isn't one by the timeout, or the job has finished, returns the latest.
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.seq > after_seq or self.finished(), timeout
+            )
+            return self.seq, self.progress
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Runs jobs on a bounded pool of threads, so they outlive the request that started them.
+
+    Only one job runs per key at a time: submitting a job with the same key (and arguments)
+    as an unfinished one returns the existing job, and with different arguments raises a
+    JobConflict. Finished jobs are remembered (up to max_finished) so their
+    results can still be fetched.
+    """
+
+    def __init__(
+        self, max_workers: int = JOB_WORKERS, max_finished: int = MAX_FINISHED_JOBS
+    ):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._max_finished = max_finished
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(
+        self, key: str, task: Callable[[], Iterator[dict]], args: dict | None = None
+    ) -> Job:
+        with self._lock:
+            for job in self._jobs.values():
+                if job.key == key and not job.finished():
+                    if job.args != (args or {}):
+                        raise JobConflict(job)
+                    return job
+            job = Job(key, args)
+            self._jobs[job.id] = job
+            self._forget_finished()
+        self._executor.submit(self._run, job, task)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job: Job, task: Callable[[], Iterator[dict]]):
+        progress = {}
+        try:
+            job.set_status(RUNNING)
+            for progress in task():
+                job.update(progress)
+            job.set_status(DONE)
+        except Exception as e:
+            traceback.print_exc()
+            job.update({**progress, "error": str(e)})
+            job.set_status(FAILED, str(e))
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished()]
+        for job_id in finished[: max(0, len(finished) - self._max_finished)]:
+            del self._jobs[job_id]
@@ -0,0 +1,70 @@
+import threading
+import unittest
+
+from jobs import DONE, FAILED, JobConflict, JobManager
+
+
+class TestJobManager(unittest.TestCase):
+    def setUp(self):
+        self.jobs = JobManager(max_workers=2, max_finished=1)
+
+    def wait_until_finished(self, job):
+        seq = 0
+        while not job.finished():
+            seq, _ = job.wait(seq, timeout=5)
+
+    def test_progress(self):
+        job = self.jobs.submit("import:test", lambda: iter([{"n": 1}, {"n": 2}]))
+        self.assertIs(self.jobs.get(job.id), job)
+        self.wait_until_finished(job)
+        self.assertEqual(job.status, DONE)
+        self.assertEqual(job.wait(0), (2, {"n": 2}))
+
+        # Already up to date, so it times out with the latest.
+        self.assertEqual(job.wait(2, timeout=0.01), (2, {"n": 2}))
+
+    def test_one_job_per_key(self):
+        release = threading.Event()
+
+        def task():
+            release.wait(5)
+            yield {"n": 1}
+
+        job = self.jobs.submit("import:test", task, {"path": "a"})
+        self.assertIs(self.jobs.submit("import:test", task, {"path": "a"}), job)
+        self.assertIsNot(self.jobs.submit("import:other", lambda: iter([])), job)
+
+        # The same key with different arguments isn't silently dropped.
+        with self.assertRaises(JobConflict) as cm:
+            self.jobs.submit("import:test", task, {"path": "b"})
+        self.assertIs(cm.exception.job, job)
+        release.set()
+        self.wait_until_finished(job)
+
+        # Once it's finished, a new job can start.
+        self.assertIsNot(self.jobs.submit("import:test", lambda: iter([])), job)
+
+    def test_failed(self):
+        def task():
+            yield {"n": 1}
+            raise ValueError("broken")
+
+        job = self.jobs.submit("import:test", task)
+        self.wait_until_finished(job)
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.error, "broken")
+        self.assertEqual(job.progress, {"n": 1, "error": "broken"})
+
+    def test_forgets_old_jobs(self):
+        first = self.jobs.submit("a", lambda: iter([]))
+        self.wait_until_finished(first)
+        second = self.jobs.submit("b", lambda: iter([]))
+        self.wait_until_finished(second)
+        self.jobs.submit("c", lambda: iter([]))
+
+        self.assertIsNone(self.jobs.get(first.id))
+        self.assertIs(self.jobs.get(second.id), second)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,27 +3,45 @@ import io
 import os
 import threading
 import webbrowser
+from typing import Mapping, Tuple
 from urllib.parse import unquote
 
 import pillow_avif  # type: ignore
-from consts import LOWERCASE_IS_TRUE, PROJECTS_DIR
+from consts import (
+    DERIVATIVE_SIZES,
+    IMAGES_PAGE_SIZE,
+    LOWERCASE_IS_TRUE,
+    MAX_IMAGES_PAGE_SIZE,
+    PNG_COMPRESS_LEVEL,
+    PROJECTS_DIR,
+    SSE_KEEPALIVE_SECS,
+)
+from derivatives import FORMATS, choose_format, derivative_etag
 from flask import (
     Flask,
     json,
     jsonify,
-    make_response,
     request,
     send_file,
     send_from_directory,
 )
 from flask_cors import CORS
 from image import Crop, valid_import_directory
-from PIL import Image
+from jobs import Job, JobConflict, JobManager
+from previews import MAX_PREVIEW_DIM, MIN_PREVIEW_DIM, rotate_preview
 from project import Project
+from registry import ProjectRegistry
+from thirdparty.tagger.run import THRESHOLD as TAGGER_THRESHOLD
+from thirdparty.tagger.run import preload_model
 from waitress.server import create_server
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--prod", action="store_true")
+parser.add_argument(
+    "--preload-tagger",
+    action="store_true",
+    help="Load the auto tagging model at startup, instead of on the first import",
+)
 args = parser.parse_args()
 
 
@@ -34,6 +52,9 @@ IS_PROD = args.prod
 app = Flask(__name__, static_folder="dist")
 CORS(app)
 
+projects = ProjectRegistry()
+jobs = JobManager()
+
 
 @app.route("/project/create", methods=["POST"])
 def create_project():
@@ -56,24 +77,167 @@ def create_project():
         }, 400
 
     Project.create_new_project(name, trigger_word)
+    projects.invalidate(name)
     return jsonify({"name": name, "triggerWord": trigger_word})
 
 
-@app.route("/project/<string:project_name>/import", methods=["GET"])
-def import_to_project(project_name):
+def int_arg(
+    name: str,
+    default: int,
+    min_value: int,
+    max_value: int | None = None,
+    args: Mapping | None = None,
+) -> int:
+    # Raises a ValueError if the argument isn't a whole number in range. Reads the query
+    # string, unless args (i.e. the JSON body) are given.
+    args = request.args if args is None else args
+    try:
+        value = int(args.get(name, default))
+    except (TypeError, ValueError):
+        raise ValueError("Must be a whole number")
+    if max_value is None and value < min_value:
+        raise ValueError(f"Must be {min_value} or more")
+    if max_value is not None and not min_value <= value <= max_value:
+        raise ValueError(f"Must be between {min_value} and {max_value}")
+    return value
+
+
+def page_args(
+    args: Mapping, with_filter: bool = True
+) -> Tuple[int, int, str | None, dict[str, str]]:
+    # The offset, limit and (completed or uncompleted) filter for a page of images.
+    # Returns (offset, limit, filter, errors), where errors are any invalid arguments.
+    errors = {}
+    offset, limit, status = 0, IMAGES_PAGE_SIZE, None
+    try:
+        offset = int_arg("offset", 0, 0, args=args)
+    except ValueError as e:
+        errors["offset"] = str(e)
+    try:
+        limit = int_arg("limit", IMAGES_PAGE_SIZE, 1, MAX_IMAGES_PAGE_SIZE, args=args)
+    except ValueError as e:
+        errors["limit"] = str(e)
+    if with_filter:
+        status = str(args.get("filter", "")).strip().lower() or None
+        if status not in (None, "completed", "uncompleted"):
+            errors["filter"] = "Must be completed or uncompleted"
+    return offset, limit, status, errors
+
+
+def submit_import(project_name: str) -> Tuple[Job | None, Tuple[dict, int] | None]:
+    # Starts importing in the background, or returns the project's import if it's already
+    # running with the same arguments. Returns (job, error), where error is the response
+    # if the arguments are invalid, or the project is already importing something else.
     import_path = unquote(request.args.get("path", "")).strip()
     remove_duplicates = (
         request.args.get("remove_duplicates", "").strip().lower() in LOWERCASE_IS_TRUE
     )
-    project = Project(project_name)
-
+    retag = request.args.get("retag", "").strip().lower() in LOWERCASE_IS_TRUE
+    optimize = request.args.get("optimize", "").strip().lower() in LOWERCASE_IS_TRUE
+
+    errors = {}
+    try:
+        # Image hashes are 64 bits.
+        max_hash_distance = int_arg("max_hash_distance", 0, 0, 64)
+    except ValueError as e:
+        errors["maxHashDistance"] = str(e)
+    try:
+        compress_level = int_arg("compress_level", PNG_COMPRESS_LEVEL, 0, 9)
+    except ValueError as e:
+        errors["compressLevel"] = str(e)
+    if errors:
+        return None, ({"errors": errors}, 400)
+
+    project = projects.get(project_name)
+    try:
+        job = jobs.submit(
+            f"import:{project_name}",
+            lambda: project.import_images(
+                import_path,
+                remove_duplicates,
+                retag,
+                max_hash_distance,
+                compress_level,
+                optimize,
+            ),
+            {
+                "path": import_path,
+                "removeDuplicates": remove_duplicates,
+                "retag": retag,
+                "maxHashDistance": max_hash_distance,
+                "compressLevel": compress_level,
+                "optimize": optimize,
+            },
+        )
+    except JobConflict as e:
+        return None, (
+            {
+                "errors": {"job": "Already importing with different settings"},
+                "jobId": e.job.id,
+            },
+            409,
+        )
+    return job, None
+
+
+def stream_job(job: Job, last_seq: int = 0):
+    # Server sent events with the job's progress. Each event has the progress's seq as its
+    # id, so a client that reconnects (with Last-Event-ID) only gets newer progress.
     def generate():
-        for data in project.import_images(import_path, remove_duplicates):
-            yield f"data:{json.dumps(data)}\n\n"
+        seq = last_seq
+        while True:
+            new_seq, progress = job.wait(seq, timeout=SSE_KEEPALIVE_SECS)
+            if new_seq > seq:
+                seq = new_seq
+                yield f"id:{seq}\ndata:{json.dumps(progress)}\n\n"
+            elif job.finished():
+                break
+            else:
+                yield ": keepalive\n\n"
 
     return app.response_class(generate(), mimetype="text/event-stream")
 
 
+@app.route("/project/<string:project_name>/import", methods=["GET"])
+def import_to_project(project_name):
+    # The import runs in the background, so it carries on if the client goes away.
+    job, error = submit_import(project_name)
+    if job is None:
+        return error
+    return stream_job(job)
+
+
+@app.route("/project/<string:project_name>/import/start", methods=["POST"])
+def start_import(project_name):
+    job, error = submit_import(project_name)
+    if job is None:
+        return error
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<string:job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"errors": {"job": "Job not found"}}, 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<string:job_id>/events", methods=["GET"])
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"errors": {"job": "Job not found"}}, 404
+    last_event_id = request.headers.get(
+        "Last-Event-ID", request.args.get("last_event_id", 0)
+    )
+    try:
+        last_seq = int_arg("lastEventId", 0, 0, args={"lastEventId": last_event_id})
+    except ValueError as e:
+        return {"errors": {"lastEventId": str(e)}}, 400
+    return stream_job(job, last_seq)
+
+
 @app.route("/projects/list", methods=["GET", "POST"])
 def list_projects():
     return jsonify(Project.list_all_projects())
@@ -81,38 +245,176 @@ def list_projects():
 
 @app.route("/project/<string:project_name>/get", methods=["GET", "POST"])
 def get_project(project_name):
-    project = Project(project_name)
-    return jsonify(project.to_dict())
+    project = projects.get(project_name)
+    with project.lock:
+        return jsonify(project.to_dict())
+
+
+@app.route("/project/<string:project_name>/summary", methods=["GET"])
+def get_project_summary(project_name):
+    project = projects.get(project_name)
+    with project.lock:
+        return jsonify(project.summary_to_dict())
+
+
+@app.route("/project/<string:project_name>/images", methods=["GET"])
+def list_project_images(project_name):
+    offset, limit, status, errors = page_args(request.args)
+    if errors:
+        return {"errors": errors}, 400
+
+    project = projects.get(project_name)
+    with project.lock:
+        images, completed, total = project.images_page(offset, limit, status)
+    return jsonify(
+        {
+            "images": images,
+            "completed": completed,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+        }
+    )
 
 
 @app.route("/project/<string:project_name>/save", methods=["GET", "POST"])
 def save_project(project_name):
-    project = Project(project_name)
+    project = projects.get(project_name)
     data = request.json if request.json else {}
-    project.save(data)
+    with project.lock:
+        project.save(data)
     return jsonify({"result": "OK"})
 
 
+@app.route("/project/<string:project_name>/manifest/rebuild", methods=["POST"])
+def rebuild_manifest(project_name):
+    project = projects.get(project_name)
+    with project.lock:
+        project.rebuild_manifest()
+        return jsonify({"result": "OK", "totalImages": len(project.imgs)})
+
+
+@app.route("/project/<string:project_name>/auto_tags/rederive", methods=["POST"])
+def rederive_auto_tags(project_name):
+    # Rewrites the auto tags with a new threshold (and/or without some tags), using the
+    # tagger's stored confidents rather than running it again.
+    data = request.json if request.json else {}
+    try:
+        threshold = float(data.get("threshold", TAGGER_THRESHOLD))
+    except (TypeError, ValueError):
+        return {"errors": {"threshold": "Must be a number"}}, 400
+    if not 0 <= threshold <= 1:
+        return {"errors": {"threshold": "Must be between 0 and 1"}}, 400
+    exclude_tags = [str(tag).strip() for tag in data.get("excludeTags", [])]
+
+    project = projects.get(project_name)
+    total_images = project.rederive_auto_tags(threshold, exclude_tags)
+    return jsonify({"result": "OK", "totalImages": total_images})
+
+
 @app.route("/project/<string:project_name>/tags/save", methods=["POST"])
 def save_image_tags(project_name):
-    project = Project(project_name)
+    # Saves by filename, rather than changing the shared project's selected image.
+    project = projects.get(project_name)
     data = request.json if request.json else {}
-    project.set_selected_image(data.get("filename", ""))
-    project.save_txt_file(data.get("txtFile", ""))
+    filename = str(data.get("filename", "")).strip()
+    with project.lock:
+        errors = project.save_txt_files({filename: str(data.get("txtFile", ""))})
+    if errors[filename]:
+        return {"errors": {"filename": errors[filename]}}, 400
     return jsonify({"result": "OK"})
 
 
+@app.route("/project/<string:project_name>/tags/save_many", methods=["POST"])
+def save_many_image_tags(project_name):
+    # Saves the tags for many images in one go, i.e. when applying a tag to a selection.
+    # Expects {"images": [{"filename": ..., "txtFile": ...}, ...]}.
+    data = request.json if request.json else {}
+    project = projects.get(project_name)
+    txt_files = {
+        str(img.get("filename", "")).strip(): str(img.get("txtFile", ""))
+        for img in data.get("images", [])
+    }
+    if len(txt_files) > MAX_IMAGES_PAGE_SIZE:
+        return {"errors": {"images": f"At most {MAX_IMAGES_PAGE_SIZE} at a time"}}, 400
+
+    with project.lock:
+        errors = project.save_txt_files(txt_files)
+    return jsonify(
+        {
+            "results": [
+                (
+                    {"filename": fname, "result": "ERROR", "error": error}
+                    if error
+                    else {"filename": fname, "result": "OK"}
+                )
+                for fname, error in errors.items()
+            ]
+        }
+    )
+
+
 @app.route("/project/<string:project_name>/tags/load", methods=["GET", "POST"])
 def load_image_tags(project_name):
-    project = Project(project_name)
-    filename = request.args.get("image", "")
-    project.set_selected_image(filename)
-    return jsonify(project.selected_image_to_dict())
+    project = projects.get(project_name)
+    filename = request.args.get("image", "").strip()
+    with project.lock:
+        if filename not in project.imgs:
+            return {"errors": {"image": "Image not found"}}, 404
+        return jsonify(project.image_to_dict(filename))
+
+
+@app.route("/project/<string:project_name>/tags/load_many", methods=["POST"])
+def load_many_image_tags(project_name):
+    # Tags for a list of filenames, or a page of images (see list_project_images), e.g. to
+    # prefetch the next few images. Doesn't change the selected image.
+    data = request.json if request.json else {}
+    project = projects.get(project_name)
+    if "filenames" in data:
+        filenames = [str(f).strip() for f in data["filenames"]]
+    else:
+        offset, limit, status, errors = page_args(data)
+        if errors:
+            return {"errors": errors}, 400
+        with project.lock:
+            filenames, _, _ = project.images_page(offset, limit, status)
+    if len(filenames) > MAX_IMAGES_PAGE_SIZE:
+        return {
+            "errors": {"filenames": f"At most {MAX_IMAGES_PAGE_SIZE} at a time"}
+        }, 400
+
+    images, missing = project.load_tags(filenames)
+    return jsonify({"images": images, "missing": missing})
+
+
+@app.route("/project/<string:project_name>/tags/query", methods=["GET"])
+def query_image_tags(project_name):
+    # Finds the images with all of the "all" tags, any of the "any" tags, and none of the
+    # "none" tags. Each is a comma separated list, like the txt files, e.g.
+    # ?all=red hair,smiling&none=hat. Paged like list_project_images.
+    def tag_list(param: str) -> list[str]:
+        tags = request.args.get(param, "").split(",")
+        return [tag.strip() for tag in tags if tag.strip()]
+
+    offset, limit, _, errors = page_args(request.args, with_filter=False)
+    if errors:
+        return {"errors": errors}, 400
+
+    project = projects.get(project_name)
+    images = project.find_images(tag_list("all"), tag_list("any"), tag_list("none"))
+    return jsonify(
+        {
+            "images": images[offset : offset + limit],
+            "total": len(images),
+            "offset": offset,
+            "limit": limit,
+        }
+    )
 
 
 @app.route("/project/<string:project_name>/imgs/<string:fname>", methods=["GET"])
 def serve_image(project_name, fname):
-    project = Project(project_name)
+    project = projects.get(project_name)
     img_path = project.img_path(fname)
 
     # Check the file exists.
@@ -120,36 +422,65 @@ def serve_image(project_name, fname):
         return jsonify(errors={"fname": "Image file not found"}), 404
 
     # Preview rotation
-    left_rotate = int(request.args.get("rotate", 0))
+    try:
+        left_rotate = int_arg("rotate", 0, 0, 359)
+    except ValueError as e:
+        return jsonify(errors={"rotate": str(e)}), 400
     if left_rotate > 0:
-        rotated_image = Image.open(img_path)
-        if left_rotate:
-            rotated_image = rotated_image.rotate(-left_rotate, expand=True)
-        img_io = io.BytesIO()
-        rotated_image.save(img_io, "PNG")
-        img_io.seek(0)
-        return send_file(img_io, mimetype="image/png")
+        # Full size by default, because the crop is measured on the preview.
+        max_dim = None
+        if "max_dim" in request.args:
+            try:
+                max_dim = int_arg("max_dim", 0, MIN_PREVIEW_DIM, MAX_PREVIEW_DIM)
+            except ValueError as e:
+                return jsonify(errors={"max_dim": str(e)}), 400
+        webp = "image/webp" in request.headers.get("Accept", "")
+        data, mimetype = rotate_preview(img_path, left_rotate, max_dim, webp)
+        response = send_file(io.BytesIO(data), mimetype=mimetype)
+        response.headers["Vary"] = "Accept"
+        return response
 
     # Thumbnail?
     thumbnail = request.args.get("thumbnail", "").strip().lower() in LOWERCASE_IS_TRUE
     if thumbnail:
-        img = Image.open(img_path)
-        img.thumbnail((250, int(250 * img.height / img.width)))
-        img_io = io.BytesIO()
-        img.save(img_io, "PNG")
-        img_io.seek(0)
-        response = make_response(send_file(img_io, mimetype="image/png"))
+        # Served with an ETag and Last-Modified, so the browser can revalidate cheaply.
+        thumb_path = project.thumbnail_path(fname)
+        response = send_from_directory(project.thumbs_dir(), thumb_path.name)
         response.headers["Cache-Control"] = "public, max-age=31536000"  # 1 year
         return response
 
     return send_from_directory(project.img_dir(), fname)
 
 
+@app.route(
+    "/project/<string:project_name>/imgs/<string:fname>/<int:size>", methods=["GET"]
+)
+def serve_image_derivative(project_name, fname, size):
+    # The image resized to fit in size x size, in the best format the browser accepts.
+    if size not in DERIVATIVE_SIZES:
+        return jsonify(errors={"size": f"Must be one of {DERIVATIVE_SIZES}"}), 400
+    project = projects.get(project_name)
+    img_path = project.img_path(fname)
+    if not os.path.exists(img_path):
+        return jsonify(errors={"fname": "Image file not found"}), 404
+
+    ext = choose_format(request.headers.get("Accept", ""))
+    response = send_file(
+        project.derivative_path(fname, size, ext),
+        mimetype=FORMATS[ext][1],
+        etag=derivative_etag(img_path, size, ext),
+    )
+    # Always revalidate, which is cheap thanks to the ETag (a 304 if it's unchanged).
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept"
+    return response
+
+
 @app.route("/project/<string:project_name>/img/delete", methods=["POST"])
 def delete_image(project_name):
     data = request.json if request.json else {}
     filename = str(data.get("filename", "")).strip()
-    project = Project(project_name)
+    project = projects.get(project_name)
     project.delete_image(filename)
     return jsonify({"result": "OK"})
 
@@ -168,7 +499,7 @@ def edit_image(project_name):
         crop_data.get("width", 0),
         crop_data.get("height", 0),
     )
-    project = Project(project_name)
+    project = projects.get(project_name)
     new_filename = project.edit_image(filename, left_rotate, flip, crop)
     if not new_filename:
         return {
@@ -183,7 +514,7 @@ def edit_image(project_name):
 def duplicate_image(project_name):
     data = request.json if request.json else {}
     filename = str(data.get("filename", "")).strip()
-    project = Project(project_name)
+    project = projects.get(project_name)
     new_filename, has_txt_file = project.duplicate_image(filename)
     if not new_filename:
         return {
@@ -214,6 +545,9 @@ if __name__ == "__main__":
     if not os.path.exists(PROJECTS_DIR):
         os.makedirs(PROJECTS_DIR, exist_ok=True)
 
+    if args.preload_tagger:
+        threading.Thread(target=preload_model, daemon=True).start()
+
     if IS_PROD:
         threading.Timer(
             1.25, lambda: webbrowser.open_new(f"http://127.0.0.1:{PORT}")
@@ -0,0 +1,207 @@
+import json
+import os
+import sqlite3
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+from consts import IMG_EXT
+from image import parse_image_filename
+from PIL import Image
+
+
+class ImageEntry:
+    def __init__(
+        self,
+        name: str,
+        width: int,
+        height: int,
+        hash: str,
+        completed: bool,
+        auto_tags: list[str],
+    ):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.hash = hash
+        self.completed = completed
+        self.auto_tags = auto_tags
+
+
+class Manifest:
+    """Everything we need to know about a project's images, in a single SQLite file.
+
+    Loading a project from the manifest is one query, instead of listing the image directory,
+    checking the size of every caption and reading every auto tags file. The Project methods
+    that change images keep it up to date, and rebuild() recreates it from the files on disk
+    if it ever drifts.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    @contextmanager
+    def _transaction(self):
+        # A new connection each time, so the manifest can be used from any thread.
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS images (
+                        name TEXT PRIMARY KEY,
+                        width INTEGER,
+                        height INTEGER,
+                        hash TEXT,
+                        completed INTEGER NOT NULL DEFAULT 0,
+                        auto_tags TEXT NOT NULL DEFAULT '[]'
+                    )
+                    """
+                )
+                yield conn
+        finally:
+            conn.close()
+
+    def images(self) -> list[ImageEntry]:
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT name, width, height, hash, completed, auto_tags FROM images ORDER BY name"
+            ).fetchall()
+        return [
+            ImageEntry(
+                name, width, height, hash, bool(completed), json.loads(auto_tags)
+            )
+            for name, width, height, hash, completed, auto_tags in rows
+        ]
+
+    def completed(self) -> list[tuple[str, bool]]:
+        # Just (name, completed) for every image, for listing them without decoding all
+        # the auto tags.
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT name, completed FROM images ORDER BY name"
+            ).fetchall()
+        return [(name, bool(completed)) for name, completed in rows]
+
+    def add(self, entries: list[ImageEntry]):
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        e.name,
+                        e.width,
+                        e.height,
+                        e.hash,
+                        int(e.completed),
+                        json.dumps(e.auto_tags),
+                    )
+                    for e in entries
+                ],
+            )
+
+    def set_completed(self, completed: dict[str, bool]):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE images SET completed = ? WHERE name = ?",
+                [(int(done), name) for name, done in completed.items()],
+            )
+
+    def set_auto_tags(self, auto_tags: dict[str, list[str]]):
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE images SET auto_tags = ? WHERE name = ?",
+                [(json.dumps(tags), name) for name, tags in auto_tags.items()],
+            )
+
+    def rename(self, name: str, new_name: str, width: int, height: int):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE images SET name = ?, width = ?, height = ? WHERE name = ?",
+                (new_name, width, height, name),
+            )
+
+    def copy(self, name: str, new_name: str):
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO images
+                SELECT ?, width, height, hash, completed, auto_tags FROM images WHERE name = ?
+                """,
+                (new_name, name),
+            )
+
+    def delete(self, name: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM images WHERE name = ?", (name,))
+
+    def rebuild(self, img_dir: Path, auto_tags_dir: Path):
+        """Recreates the manifest from the images, captions and auto tags on disk."""
+        entries = []
+        names = os.listdir(img_dir) if os.path.isdir(img_dir) else []
+        for f in names:
+            if not f.endswith(IMG_EXT):
+                continue
+
+            info = parse_image_filename(f)
+            if info:
+                hash, width, height = info
+            else:
+                hash, width, height = "", 0, 0
+                try:
+                    # Only reads the header.
+                    with Image.open(os.path.join(img_dir, f)) as img:
+                        width, height = img.size
+                except OSError:
+                    pass
+
+            txt_path = os.path.join(img_dir, f"{Path(f).stem}.txt")
+            completed = os.path.exists(txt_path) and os.path.getsize(txt_path) > 0
+
+            entries.append(
+                ImageEntry(
+                    f,
+                    width,
+                    height,
+                    hash,
+                    completed,
+                    read_auto_tags(os.path.join(auto_tags_dir, f"{Path(f).stem}.txt")),
+                )
+            )
+
+        # All in one transaction, so nobody sees a half built manifest.
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM images")
+            conn.executemany(
+                "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        e.name,
+                        e.width,
+                        e.height,
+                        e.hash,
+                        int(e.completed),
+                        json.dumps(e.auto_tags),
+                    )
+                    for e in entries
+                ],
+            )
+
+
+def read_auto_tags(path: Path | str) -> list[str]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as fp:
+        return [tag.strip() for tag in fp.read().split(",") if tag.strip()]
+
+
+if __name__ == "__main__":
+    # Usage: python manifest.py <project name>
+    from project import Project
+
+    project = Project(sys.argv[1])
+    project.rebuild_manifest()
+    print(f"Rebuilt the manifest for {project.name}: {len(project.imgs)} images")
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from manifest import ImageEntry, Manifest
+from PIL import Image
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.img_dir = os.path.join(self.temp_dir.name, "imgs")
+        self.auto_tags_dir = os.path.join(self.temp_dir.name, "auto_tags")
+        os.makedirs(self.img_dir)
+        os.makedirs(self.auto_tags_dir)
+        self.manifest = Manifest(os.path.join(self.temp_dir.name, "manifest.db"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_changes(self):
+        self.assertFalse(self.manifest.exists())
+        self.manifest.add(
+            [
+                ImageEntry("a_10x20_0.png", 10, 20, "a", False, ["red", "scarf"]),
+                ImageEntry("b_30x40_0.png", 30, 40, "b", True, []),
+            ]
+        )
+        self.assertTrue(self.manifest.exists())
+
+        self.manifest.set_completed({"a_10x20_0.png": True})
+        self.manifest.set_auto_tags({"b_30x40_0.png": ["hat"]})
+        self.manifest.copy("a_10x20_0.png", "a_10x20_1.png")
+        self.manifest.rename("a_10x20_0.png", "a_20x10_2.png", 20, 10)
+        self.manifest.delete("a_10x20_1.png")
+
+        self.assertEqual(
+            [
+                (e.name, e.width, e.height, e.hash, e.completed, e.auto_tags)
+                for e in self.manifest.images()
+            ],
+            [
+                ("a_20x10_2.png", 20, 10, "a", True, ["red", "scarf"]),
+                ("b_30x40_0.png", 30, 40, "b", True, ["hat"]),
+            ],
+        )
+        self.assertEqual(
+            self.manifest.completed(),
+            [("a_20x10_2.png", True), ("b_30x40_0.png", True)],
+        )
+
+    def test_rebuild(self):
+        self.manifest.add([ImageEntry("gone.png", 1, 1, "", False, [])])
+
+        Image.new("RGB", (60, 30)).save(os.path.join(self.img_dir, "other.png"))
+        open(os.path.join(self.img_dir, "abcd_60x30_0.png"), "w").close()
+        with open(os.path.join(self.img_dir, "abcd_60x30_0.txt"), "w") as fp:
+            fp.write("some, tags")
+        with open(os.path.join(self.auto_tags_dir, "abcd_60x30_0.txt"), "w") as fp:
+            fp.write("red, , scarf")
+
+        self.manifest.rebuild(self.img_dir, self.auto_tags_dir)
+        self.assertEqual(
+            [
+                (e.name, e.width, e.height, e.hash, e.completed, e.auto_tags)
+                for e in self.manifest.images()
+            ],
+            [
+                ("abcd_60x30_0.png", 60, 30, "abcd", True, ["red", "scarf"]),
+                ("other.png", 60, 30, "", False, []),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import io
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from consts import PREVIEW_CACHE_SIZE, PREVIEW_MAX_DIM
+from PIL import Image
+
+MIN_PREVIEW_DIM = 64
+MAX_PREVIEW_DIM = 4096
+
+
+def rotate_preview(
+    img_path: Path, left_rotate: int, max_dim: int | None = None, webp: bool = True
+) -> tuple[bytes, str]:
+    """Rotate Preview.
+
+    Returns (data, mimetype) for a preview of the image rotated by left_rotate degrees,
+    encoded as WebP (or JPEG), and cached so rotating the same image again is almost free.
+    By default it's the same size as the rotated original, because the crop is measured on
+    it. With max_dim, it's no bigger than max_dim pixels on either side, and small sizes are
+    rendered from a shared downscaled copy. The caches are keyed on the image's mtime, so
+    edits are picked up.
+    """
+    if max_dim is not None:
+        max_dim = min(max(max_dim, MIN_PREVIEW_DIM), MAX_PREVIEW_DIM)
+    mtime_ns = os.stat(img_path).st_mtime_ns
+    data = _render(str(img_path), mtime_ns, left_rotate % 360, max_dim, webp)
+    return data, "image/webp" if webp else "image/jpeg"
+
+
+@lru_cache(maxsize=8)
+def _proxy(img_path: str, mtime_ns: int) -> Image.Image:
+    # Always PREVIEW_MAX_DIM, so the cache stays small whatever sizes are asked for.
+    # Don't modify the result, it's shared.
+    with Image.open(img_path) as img:
+        img.thumbnail((PREVIEW_MAX_DIM, PREVIEW_MAX_DIM))
+        return img.convert("RGB")
+
+
+def _fit(size: tuple[int, int], max_dim: int) -> tuple[int, int]:
+    scale = max_dim / max(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+@lru_cache(maxsize=PREVIEW_CACHE_SIZE)
+def _render(
+    img_path: str, mtime_ns: int, left_rotate: int, max_dim: int | None, webp: bool
+) -> bytes:
+    if max_dim is not None and max_dim <= PREVIEW_MAX_DIM:
+        # rotate() and resize() return copies, so the shared proxy isn't modified.
+        img = _proxy(img_path, mtime_ns)
+    else:
+        with Image.open(img_path) as original:
+            img = original.convert("RGB")
+    if left_rotate:
+        img = img.rotate(-left_rotate, expand=True)
+    if max_dim is not None:
+        # Non right angles make the image bigger.
+        img = img.resize(_fit(img.size, max_dim)) if max(img.size) > max_dim else img
+
+    buffer = io.BytesIO()
+    if webp:
+        img.save(buffer, "WEBP", quality=80, method=0)
+    else:
+        img.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
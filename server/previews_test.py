@@ -0,0 +1,58 @@
+import io
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from PIL import Image
+from previews import rotate_preview
+
+
+class TestRotatePreview(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.img_path = Path(self.temp_dir.name).joinpath("test.png")
+        Image.new("RGB", (400, 200), color="red").save(self.img_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_rotate_preview(self):
+        data, mimetype = rotate_preview(self.img_path, 90, max_dim=100)
+        self.assertEqual(mimetype, "image/webp")
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.format, "WEBP")
+            self.assertEqual(img.size, (50, 100))
+
+        # Cached.
+        self.assertIs(rotate_preview(self.img_path, 90, max_dim=100)[0], data)
+
+        data, mimetype = rotate_preview(self.img_path, 45, max_dim=100, webp=False)
+        self.assertEqual(mimetype, "image/jpeg")
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertLessEqual(max(img.size), 100)
+
+    def test_full_size(self):
+        # By default, the crop can be measured on the preview.
+        data, _ = rotate_preview(self.img_path, 90)
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.size, (200, 400))
+
+        data, _ = rotate_preview(self.img_path, 90, max_dim=5000)
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.size, (200, 400))
+
+    def test_image_changed(self):
+        data, _ = rotate_preview(self.img_path, 90, max_dim=100)
+
+        Image.new("RGB", (200, 200), color="blue").save(self.img_path)
+        mtime = os.stat(self.img_path).st_mtime_ns + 1_000_000_000
+        os.utime(self.img_path, ns=(mtime, mtime))
+
+        data, _ = rotate_preview(self.img_path, 90, max_dim=100)
+        with Image.open(io.BytesIO(data)) as img:
+            self.assertEqual(img.size, (100, 100))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,27 +1,65 @@
+import bisect
 import json
 import os
 import shutil
+import tempfile
 import threading
-import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import Tuple
 
-project_save_lock = threading.Lock()
-
-import imagehash
 from consts import (
     AUTO_TAGS,
     DEFAULT_CATEGORY_FILE,
+    DERIVATIVES_DIR,
+    IMAGES_PAGE_SIZE,
     IMG_EXT,
     IMGS_DIR,
+    IMPORT_WORKERS,
+    MANIFEST_FILE,
+    PNG_COMPRESS_LEVEL,
     PROJECT_CATEGORY_FILE,
     PROJECT_CONFIG_FILE,
     PROJECTS_DIR,
+    TAG_READ_WORKERS,
+    THUMBS_DIR,
+)
+from derivatives import delete_derivatives, make_derivative
+from files import dir_lock, write_atomically, write_behind_file
+from hash_index import HashIndex
+from image import (
+    Crop,
+    FilenameIndex,
+    choose_image_filename,
+    convert_for_import,
+    get_image_i,
+    parse_image_filename,
+    valid_images_for_import,
 )
-from image import Crop, choose_image_filename, get_image_i, valid_images_for_import
+from manifest import ImageEntry, Manifest, read_auto_tags
 from PIL import Image
-from tags import common_suffixes
-from thirdparty.tagger.run import interrogate_directory
+from tag_index import TagIndex
+from tags import common_suffixes, suffix_matcher
+from thirdparty.tagger.run import (
+    THRESHOLD,
+    ConfidenceStore,
+    images_to_interrogate,
+    interrogate_directory,
+    rederive_auto_tags,
+)
+from thumbnails import (
+    delete_thumbnail,
+    make_thumbnail,
+    make_thumbnails_in_background,
+)
+
+# Reads caption files for load_tags(). Shared by all projects, since it's mostly waiting on
+# the disk.
+_tag_read_executor = ThreadPoolExecutor(
+    max_workers=TAG_READ_WORKERS, thread_name_prefix="tags"
+)
 
 
 class TagInfo:
@@ -53,6 +91,21 @@ class TagCategory:
 
 
 class Project:
+    # Parts of the project that are loaded from disk the first time they're used, and the
+    # attributes they set. Each group is loaded by its _load_{group}() method.
+    _LAZY_GROUPS = {
+        "imgs": ["imgs", "completed"],
+        "config": ["selected_image", "trigger_word", "trigger_synonyms", "hidden_tags"],
+        "tag_layout": ["project_layout"],
+        "auto_tags": ["auto_tags", "requires_setup"],
+        "filenames": ["filename_index"],
+        "auto_tag_counts": ["auto_tag_counts"],
+        "tag_index": ["tag_index"],
+    }
+    _LAZY_ATTRS = {
+        attr: group for group, attrs in _LAZY_GROUPS.items() for attr in attrs
+    }
+
     def __init__(self, name: str, projects_dir: str | None = None):
         self.name = name
 
@@ -68,7 +121,35 @@ class Project:
         # The auto tags subdirectory.
         self._auto_tags_dir = Path(os.path.join(self._base_dir, AUTO_TAGS))
 
-        self._load()
+        # Cached thumbnails.
+        self._thumbs_dir = Path(os.path.join(self._base_dir, THUMBS_DIR))
+
+        # Cached copies of the images in other sizes and formats.
+        self._derivatives_dir = Path(os.path.join(self._base_dir, DERIVATIVES_DIR))
+
+        # Config changes are written in the background, see save().
+        self._config_file = write_behind_file(
+            self._base_dir.joinpath(PROJECT_CONFIG_FILE)
+        )
+
+        # Optional, see Manifest. Without one, the images are listed from disk.
+        self._manifest = Manifest(self._base_dir.joinpath(MANIFEST_FILE))
+
+        # Projects are shared between requests, so guard any per-request state (i.e. the
+        # selected image) with this lock.
+        self.lock = threading.RLock()
+
+        # Guards the project's files, and is shared with any other Project for the same
+        # directory. Only hold it while reading or writing files: never take self.lock, or
+        # load part of the project, while holding it.
+        self._files = dir_lock(self._base_dir)
+
+        # Snapshots of the files each loaded group came from, see refresh().
+        self._snapshots: dict[str, tuple[int | None, ...]] = {}
+
+        # Bumped whenever auto_tag_counts changes, so we know when to redo the analysis.
+        self._auto_tag_counts_version = 0
+        self._analyzed_auto_tags: tuple[int, list[TagInfo]] | None = None
 
     @staticmethod
     def create_new_project(
@@ -82,6 +163,7 @@ class Project:
         if trigger_word:
             project.trigger_word = trigger_word
             project.save()
+            project.flush()
         return project, ""
 
     def _make_dirs(self):
@@ -98,9 +180,20 @@ class Project:
     def auto_tags_dir(self) -> Path:
         return self._auto_tags_dir
 
+    def thumbs_dir(self) -> Path:
+        return self._thumbs_dir
+
     def img_path(self, fname: str) -> Path:
         return Path(os.path.join(self._img_dir, fname))
 
+    def thumbnail_path(self, fname: str) -> Path:
+        # Generates the thumbnail if it doesn't exist yet.
+        return make_thumbnail(self.img_path(fname), self._thumbs_dir)
+
+    def derivative_path(self, fname: str, size: int, ext: str) -> Path:
+        # Generates the derivative if it doesn't exist yet.
+        return make_derivative(self.img_path(fname), self._derivatives_dir, size, ext)
+
     def selected_image_path(self) -> Path:
         return Path(self.img_path(self.selected_image))
 
@@ -117,60 +210,195 @@ class Project:
             raise ValueError(f"Invalid image name: {image_name}")
         self.selected_image = image_name
 
-    def _load(self):
-        self.project_layout = self._project_tag_categories()
-        self.imgs, self.completed = self._list_all_imgs()
-        self.trigger_word = ""
-        self.trigger_synonyms = []
-        self.selected_image = ""
-        self.auto_tags = []
-        self.hidden_tags = []
-        self.requires_setup = False
-
-        # Load config file.
-        self._load_config()
-
-        # Load the auto tags.
-        if len(self.project_layout) == 0:
-            self.project_layout = self._default_tag_categories()
-            self.auto_tags = self._get_filtered_auto_tags(self.project_layout)
-            self.requires_setup = len(self.auto_tags) > 0
+    def refresh(self):
+        # Forget any parts of the project that have changed on disk since we loaded them.
+        with self.lock:
+            for group, snapshot in list(self._snapshots.items()):
+                if self._snapshot(group) != snapshot:
+                    self._forget(group)
+
+    def _forget(self, *groups: str):
+        # The next access to any of the group's attributes will reload it.
+        with self.lock:
+            for group in groups:
+                self._snapshots.pop(group, None)
+                for attr in Project._LAZY_GROUPS[group]:
+                    self.__dict__.pop(attr, None)
+
+    def _snapshots_of(self, *groups: str) -> dict[str, tuple[int | None, ...]]:
+        # Call while still holding the files write lock after changing them, so changes
+        # made by anyone else afterwards aren't mistaken for ours. See _touched().
+        return {group: self._snapshot(group) for group in groups}
+
+    def _touched(self, snapshots: dict[str, tuple[int | None, ...]]):
+        # We've changed the files these groups are loaded from, and updated the groups to
+        # match, so the next refresh() doesn't need to reload them.
+        with self.lock:
+            for group, snapshot in snapshots.items():
+                if group in self._snapshots:
+                    self._snapshots[group] = snapshot
+
+    def _watched_paths(self, group: str) -> list[Path]:
+        if group in ("imgs", "filenames"):
+            return [self._img_dir]
+        elif group == "config":
+            return [self._base_dir.joinpath(PROJECT_CONFIG_FILE)]
+        elif group == "auto_tag_counts":
+            return [self._auto_tags_dir]
+        elif group == "tag_index":
+            return [self._img_dir, self._auto_tags_dir]
+        elif group == "tag_layout":
+            return [self._base_dir.joinpath(PROJECT_CATEGORY_FILE)]
+        return [self._auto_tags_dir, self._base_dir.joinpath(PROJECT_CATEGORY_FILE)]
+
+    def _snapshot(self, group: str) -> tuple[int | None, ...]:
+        # Modification times of everything the group is loaded from. Adding, removing or
+        # renaming a file updates the mtime of its directory.
+        mtimes = []
+        for path in self._watched_paths(group):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def __getattr__(self, name: str):
+        # Only called for attributes that haven't been set, i.e. that haven't been loaded yet.
+        group = Project._LAZY_ATTRS.get(name)
+        if group is None:
+            raise AttributeError(
+                f"'{type(self).__name__}' object has no attribute '{name}'"
+            )
+        with self.lock:
+            if name not in self.__dict__:
+                # Take the snapshot first, so any changes made while we're loading are
+                # picked up by the next refresh.
+                self._snapshots[group] = self._snapshot(group)
+                getattr(self, f"_load_{group}")()
+            # Read it while we hold the lock, before anyone else can forget it again.
+            return self.__dict__[name]
+
+    def _load_imgs(self):
+        imgs, completed = self._list_all_imgs()
+        self.__dict__.setdefault("imgs", imgs)
+        self.__dict__.setdefault("completed", completed)
+
+    def _load_filenames(self):
+        self.__dict__.setdefault("filename_index", FilenameIndex(self._img_dir))
+
+    def _load_auto_tag_counts(self):
+        self.__dict__.setdefault("auto_tag_counts", Counter(self._get_all_auto_tags()))
+        self._auto_tag_counts_version += 1
+
+    def _update_auto_tag_counts(self, added: list[str] = [], removed: list[str] = []):
+        # Keep the counts in step with the auto tags files we add, change or delete. If they
+        # haven't been loaded yet, they'll be counted from scratch when they are.
+        with self.lock:
+            if "auto_tag_counts" not in self.__dict__:
+                return
+            counts = self.auto_tag_counts
+            counts.update(added)
+            counts.subtract(removed)
+            for tag in removed:
+                if counts[tag] <= 0:
+                    del counts[tag]
+            self._auto_tag_counts_version += 1
+
+    def _load_tag_index(self):
+        index = TagIndex()
+        for fname in self.imgs:
+            index.add(fname)
+
+        # Only completed images have tags to read.
+        completed = self.completed
+        txt_paths = [self.img_path(f).with_suffix(".txt") for f in completed]
+        index.set_many_tags(
+            dict(
+                zip(
+                    completed,
+                    _tag_read_executor.map(self._load_tags_from_file, txt_paths),
+                )
+            )
+        )
+        index.set_many_tags(
+            {
+                fname: auto_tags
+                for fname, auto_tags in self._read_all_auto_tags().items()
+                if fname in index
+            },
+            auto=True,
+        )
+        self.__dict__.setdefault("tag_index", index)
+
+    def _update_tag_index(
+        self,
+        tags: dict[str, list[str]] = {},
+        auto_tags: dict[str, list[str]] = {},
+        copied: dict[str, str] = {},
+        removed: list[str] = [],
+    ):
+        # Keep the index in step with the tags we save, copy or delete, like
+        # _update_auto_tag_counts(). copied is {filename: new_filename}.
+        with self.lock:
+            if "tag_index" not in self.__dict__:
+                return
+            index = self.tag_index
+            for fname, new_fname in copied.items():
+                index.copy(fname, new_fname)
+            index.set_many_tags(tags)
+            index.set_many_tags(auto_tags, auto=True)
+            for fname in removed:
+                index.remove(fname)
+
+    def _load_tag_layout(self):
+        project_layout = self._project_tag_categories()
+        if len(project_layout) == 0:
+            project_layout = self._default_tag_categories()
+        self.__dict__.setdefault("project_layout", project_layout)
+
+    def _load_auto_tags(self):
+        if len(self._project_tag_categories()) == 0:
+            auto_tags = self._get_filtered_auto_tags(self._default_tag_categories())
+            requires_setup = len(auto_tags) > 0
         else:
             # Don't filter, because we want all examples now the project is setup.
-            self.auto_tags = self._get_filtered_auto_tags([])
+            auto_tags = self._get_filtered_auto_tags([])
+            requires_setup = False
+        self.__dict__.setdefault("auto_tags", auto_tags)
+        self.__dict__.setdefault("requires_setup", requires_setup)
 
     def _load_config(self):
-        file_path = os.path.join(self._base_dir, PROJECT_CONFIG_FILE)
-        if not os.path.exists(file_path):
-            return
-        # TODO: If contention proves to still be an issue, cache the project config instead of reading it off disk.
-        retries = 3
-        delay = 1
-        for i in range(retries):
-            try:
-                with open(file_path, "r") as fp:
-                    data = json.load(fp)
-                    if "selectedImage" in data:
-                        self.selected_image = data["selectedImage"]
-                    if "triggerWord" in data:
-                        self.trigger_word = data["triggerWord"]
-                    if "triggerSynonyms" in data:
-                        self.trigger_synonyms = data["triggerSynonyms"]
-                    if "hiddenTags" in data:
-                        self.hidden_tags = data["hiddenTags"]
-                break
-            except IOError:
-                if i < retries - 1:
-                    time.sleep(delay)
-                else:
-                    raise IOError(f"Failed to read {file_path}, too much contention")
+        config = {
+            "selected_image": "",
+            "trigger_word": "",
+            "trigger_synonyms": [],
+            "hidden_tags": [],
+        }
+
+        # Includes any changes that haven't been written yet.
+        contents = self._config_file.read()
+        if contents is not None:
+            data = json.loads(contents)
+            if "selectedImage" in data:
+                config["selected_image"] = data["selectedImage"]
+            if "triggerWord" in data:
+                config["trigger_word"] = data["triggerWord"]
+            if "triggerSynonyms" in data:
+                config["trigger_synonyms"] = data["triggerSynonyms"]
+            if "hiddenTags" in data:
+                config["hidden_tags"] = data["hiddenTags"]
+
+        # Keep anything that was set before the config was loaded.
+        for attr, value in config.items():
+            self.__dict__.setdefault(attr, value)
 
     def save(self, data: dict = {}):
         # Save the tag layout.
         if "tagLayout" in data:
             file_path = os.path.join(self._base_dir, PROJECT_CATEGORY_FILE)
-            with open(file_path, "w") as fp:
-                json.dump(data["tagLayout"], fp)
+            with self._files.write():
+                write_atomically(file_path, json.dumps(data["tagLayout"]))
+            self._forget("tag_layout", "auto_tags")
 
         # Save the config file.
         if "selectedImage" in data:
@@ -185,26 +413,71 @@ class Project:
         if "hiddenTags" in data:
             self.hidden_tags = data["hiddenTags"]
 
-        file_path = os.path.join(self._base_dir, PROJECT_CONFIG_FILE)
-        with project_save_lock:
-            with open(file_path, "w") as fp:
-                json.dump(
-                    {
-                        "selectedImage": self.selected_image,
-                        "triggerWord": self.trigger_word,
-                        "triggerSynonyms": self.trigger_synonyms,
-                        "hiddenTags": self.hidden_tags,
-                    },
-                    fp,
-                )
+        # The UI saves every time the selected image changes, so rather than writing the
+        # config each time, only the latest changes are written, shortly afterwards.
+        self._config_file.write(
+            json.dumps(
+                {
+                    "selectedImage": self.selected_image,
+                    "triggerWord": self.trigger_word,
+                    "triggerSynonyms": self.trigger_synonyms,
+                    "hiddenTags": self.hidden_tags,
+                }
+            )
+        )
+
+    def flush(self):
+        # Write any config changes that are waiting to be written.
+        self._config_file.flush()
 
     def save_txt_file(self, txtFileContents: str):
-        if txtFileContents.strip() == "":
-            if os.path.exists(self.selected_image_txt_path()):
-                os.remove(self.selected_image_txt_path())
-            return
-        with open(self.selected_image_txt_path(), "w") as fp:
-            fp.write(txtFileContents)
+        self.save_txt_files({self.selected_image: txtFileContents})
+
+    def save_txt_files(self, txt_files: dict[str, str]) -> dict[str, str]:
+        """Save Txt Files.
+
+        Saves the tags for many images at once, i.e. {filename: txtFileContents}. Empty
+        contents remove the image's txt file. Returns {filename: error}, with an empty
+        error for each image that was saved.
+        """
+        with self.lock:
+            imgs = set(self.imgs)
+            completed = self.completed
+            results = {
+                fname: "" if fname in imgs else "Image not found" for fname in txt_files
+            }
+            to_save = {f: c for f, c in txt_files.items() if not results[f]}
+            with self._files.write():
+                for fname, contents in to_save.items():
+                    txt_path = self.img_path(fname).with_suffix(".txt")
+                    try:
+                        if contents.strip():
+                            write_atomically(txt_path, contents)
+                        elif os.path.exists(txt_path):
+                            os.remove(txt_path)
+                    except OSError as e:
+                        results[fname] = str(e)
+                saved = {f: c for f, c in to_save.items() if not results[f]}
+                if self._manifest.exists():
+                    self._manifest.set_completed(
+                        {f: contents.strip() != "" for f, contents in saved.items()}
+                    )
+                snapshots = self._snapshots_of("imgs", "filenames", "tag_index")
+
+            # Keep the (sorted) completed list up to date, rather than reloading it.
+            for fname, contents in saved.items():
+                i = bisect.bisect_left(completed, fname)
+                is_listed = i < len(completed) and completed[i] == fname
+                if contents.strip() and not is_listed:
+                    completed.insert(i, fname)
+                elif not contents.strip() and is_listed:
+                    del completed[i]
+
+            self._update_tag_index(
+                tags={f: contents.split(",") for f, contents in saved.items()}
+            )
+            self._touched(snapshots)
+        return results
 
     def get_selected_image_tags(self):
         return self._load_tags_from_file(self.selected_image_txt_path())
@@ -212,11 +485,24 @@ class Project:
     def get_selected_auto_image_tags(self):
         return self._load_tags_from_file(self.selected_image_auto_txt_path())
 
+    def load_tags(self, fnames: list[str]) -> Tuple[list[dict], list[str]]:
+        """Load Tags.
+
+        Returns the tags and auto tags for many images at once (reading the files in
+        parallel), without changing the selected image. Returns (results, missing), where
+        missing are any filenames that aren't in the project.
+        """
+        imgs = set(self.imgs)
+        found = [f for f in fnames if f in imgs]
+        missing = [f for f in fnames if f not in imgs]
+
+        return list(_tag_read_executor.map(self._image_tags_to_dict, found)), missing
+
     def delete(self):
+        self.flush()
         shutil.rmtree(self._base_dir)
 
     def to_dict(self):
-        self.selected_image = self.selected_image or self.imgs[0] if self.imgs else ""
         return {
             "name": self.name,
             "triggerWord": self.trigger_word,
@@ -230,14 +516,69 @@ class Project:
             "selectedImage": self.selected_image_to_dict(),
         }
 
+    def summary_to_dict(self):
+        # Enough to show the project straight away, without the (potentially huge) image
+        # lists or the auto tags. The images are fetched a page at a time, see images_page().
+        return {
+            "name": self.name,
+            "triggerWord": self.trigger_word,
+            "triggerSynonyms": self.trigger_synonyms,
+            "hiddenTags": self.hidden_tags,
+            "tagLayout": [c.to_dict() for c in self.project_layout],
+            "totalImages": len(self.imgs),
+            "totalCompleted": len(self.completed),
+            "selectedImage": self.selected_image_to_dict(),
+        }
+
+    def images_page(
+        self, offset: int = 0, limit: int = IMAGES_PAGE_SIZE, status: str | None = None
+    ) -> Tuple[list[str], list[str], int]:
+        """Images Page.
+
+        Returns (images, completed, total) for a page of the images, where completed are the
+        completed images on the page, and total is the number of images across all pages.
+        status can be "completed" or "uncompleted" to only list those images.
+        """
+        imgs = self.imgs
+        completed = set(self.completed)
+        if status is not None:
+            imgs = [f for f in imgs if (f in completed) == (status == "completed")]
+        page = imgs[offset : offset + limit]
+        return page, [f for f in page if f in completed], len(imgs)
+
+    def find_images(
+        self,
+        all_tags: list[str] = [],
+        any_tags: list[str] = [],
+        no_tags: list[str] = [],
+    ) -> list[str]:
+        """Find Images.
+
+        Returns the images that have all of all_tags, at least one of any_tags and none of
+        no_tags, matching both their tags and auto tags. Uses the tag index, so it doesn't
+        need to read any files once the index is loaded.
+        """
+        with self.lock:
+            return self.tag_index.query(all_tags, any_tags, no_tags)
+
     def selected_image_to_dict(self):
-        if not self.selected_image:
+        # Defaults to the first image, but doesn't change selected_image: that's only
+        # changed by save(), since the project is shared between requests.
+        selected_image = self.selected_image or (self.imgs[0] if self.imgs else "")
+        if not selected_image:
             return {}
+        return self.image_to_dict(selected_image)
+
+    def image_to_dict(self, fname: str):
+        return {"projectName": self.name, **self._image_tags_to_dict(fname)}
+
+    def _image_tags_to_dict(self, fname: str):
         return {
-            "projectName": self.name,
-            "filename": self.selected_image,
-            "tags": self.get_selected_image_tags(),
-            "autoTags": self.get_selected_auto_image_tags(),
+            "filename": fname,
+            "tags": self._load_tags_from_file(self.img_path(fname).with_suffix(".txt")),
+            "autoTags": self._load_tags_from_file(
+                self._auto_tags_dir.joinpath(Path(fname).stem + ".txt")
+            ),
         }
 
     def _read_tag_category_file(self, file_path: str) -> list[TagCategory]:
@@ -262,12 +603,35 @@ class Project:
 
     def _project_tag_categories(self) -> list[TagCategory]:
         file_path = os.path.join(self._base_dir, PROJECT_CATEGORY_FILE)
-        return self._read_tag_category_file(file_path)
+        with self._files.read():
+            return self._read_tag_category_file(file_path)
 
     def delete_image(self, fname):
+        self._forget("imgs")
         img_path = self.img_path(fname)
-        if os.path.exists(img_path):
-            os.remove(img_path)
+        auto_txt_path = self.auto_tags_dir().joinpath(Path(fname).stem + ".txt")
+        auto_tags = []
+        with self._files.write():
+            if os.path.exists(img_path):
+                os.remove(img_path)
+
+            # Delete any auto tags.
+            if os.path.exists(auto_txt_path):
+                auto_tags = read_auto_tags(auto_txt_path)
+                os.remove(auto_txt_path)
+            ConfidenceStore(self._auto_tags_dir).remove(Path(fname).stem)
+
+            if self._manifest.exists():
+                self._manifest.delete(fname)
+            snapshots = self._snapshots_of("filenames", "auto_tag_counts", "tag_index")
+
+        self.filename_index.discard(fname)
+        if auto_tags:
+            self._update_auto_tag_counts(removed=auto_tags)
+        self._update_tag_index(removed=[fname])
+        self._touched(snapshots)
+        delete_thumbnail(fname, self._thumbs_dir)
+        delete_derivatives(fname, self._derivatives_dir)
 
     def edit_image(
         self, fname: str, left_rotate: int, flip: bool, crop: Crop | None
@@ -277,10 +641,13 @@ class Project:
         Rotates, flips and crops an image and saves the result.
         Deletes the old file and returns the new filename.
         """
+        self._forget("imgs", "auto_tags")
         old_img_path = self.img_path(fname)
         old_image_hash = fname.split("_")[0]
         old_i = get_image_i(fname)
-        img = Image.open(old_img_path)
+        with self._files.read():
+            img = Image.open(old_img_path)
+            img.load()
 
         # Perform the edits.
         if left_rotate:
@@ -301,29 +668,49 @@ class Project:
             new_fname_prefix,
             remove_duplicates=False,
             i=old_i + 1,
+            index=self.filename_index,
         )
 
         # Save new image and delete the old one.
         new_img_path = self.img_path(new_fname)
-        img.save(new_img_path)
-
-        # Copy over any .txt file associated with the image.
-        old_txt_path = old_img_path.with_suffix(".txt")
-        if os.path.exists(old_txt_path):
-            shutil.move(old_txt_path, new_img_path.with_suffix(".txt"))
-
-        # Move any auto tags file.
-        old_auto_txt_path = self.auto_tags_dir().joinpath(old_img_path.stem + ".txt")
-        if os.path.exists(old_auto_txt_path):
-            new_auto_txt_path = self.auto_tags_dir().joinpath(
-                new_img_path.stem + ".txt"
-            )
-            shutil.move(old_auto_txt_path, new_auto_txt_path)
+        with self._files.write():
+            img.save(new_img_path)
+
+            # Copy over any .txt file associated with the image.
+            old_txt_path = old_img_path.with_suffix(".txt")
+            if os.path.exists(old_txt_path):
+                shutil.move(old_txt_path, new_img_path.with_suffix(".txt"))
 
-        self.delete_image(fname)
+            # Move any auto tags file.
+            old_auto_txt_path = self.auto_tags_dir().joinpath(
+                old_img_path.stem + ".txt"
+            )
+            if os.path.exists(old_auto_txt_path):
+                new_auto_txt_path = self.auto_tags_dir().joinpath(
+                    new_img_path.stem + ".txt"
+                )
+                shutil.move(old_auto_txt_path, new_auto_txt_path)
+            ConfidenceStore(self._auto_tags_dir).rename(
+                old_img_path.stem, new_img_path.stem
+            )
+            if self._manifest.exists():
+                self._manifest.rename(fname, new_fname, img.width, img.height)
+
+            # Everything else was moved, so only the old image is left to delete.
+            if os.path.exists(old_img_path):
+                os.remove(old_img_path)
+            snapshots = self._snapshots_of("filenames", "auto_tag_counts", "tag_index")
+
+        self.filename_index.discard(fname)
+        self._update_tag_index(copied={fname: new_fname}, removed=[fname])
+        self._touched(snapshots)
+        delete_thumbnail(fname, self._thumbs_dir)
+        delete_derivatives(fname, self._derivatives_dir)
+        make_thumbnails_in_background([new_img_path], self._thumbs_dir)
         return new_fname
 
     def duplicate_image(self, filename) -> Tuple[str, bool]:
+        self._forget("imgs", "auto_tags")
         img_path = self.img_path(filename)
         if not os.path.exists(img_path):
             return "", False
@@ -332,57 +719,142 @@ class Project:
             self._img_dir,
             Path(filename).stem.rsplit("_", 1)[0],
             remove_duplicates=False,
+            index=self.filename_index,
         )
-        img = Image.open(img_path)
-        img.save(self.img_path(new_filename))
-
-        # Copy across the .txt file if it exists.
         has_txt_file = False
-        txt_path = img_path.with_suffix(".txt")
-        if os.path.exists(txt_path):
-            has_txt_file = True
-            shutil.copy(txt_path, self.img_path(new_filename).with_suffix(".txt"))
-
-        # Copy across the auto tags, if any.
-        auto_txt_path = self.auto_tags_dir().joinpath(Path(filename).stem + ".txt")
-        if os.path.exists(auto_txt_path):
-            shutil.copy(
-                auto_txt_path,
-                self.auto_tags_dir().joinpath(new_filename).with_suffix(".txt"),
+        auto_tags = []
+        with self._files.write():
+            img = Image.open(img_path)
+            img.save(self.img_path(new_filename))
+
+            # Copy across the .txt file if it exists.
+            txt_path = img_path.with_suffix(".txt")
+            if os.path.exists(txt_path):
+                has_txt_file = True
+                shutil.copy(txt_path, self.img_path(new_filename).with_suffix(".txt"))
+
+            # Copy across the auto tags, if any.
+            auto_txt_path = self.auto_tags_dir().joinpath(Path(filename).stem + ".txt")
+            if os.path.exists(auto_txt_path):
+                shutil.copy(
+                    auto_txt_path,
+                    self.auto_tags_dir().joinpath(new_filename).with_suffix(".txt"),
+                )
+                auto_tags = read_auto_tags(auto_txt_path)
+            ConfidenceStore(self._auto_tags_dir).copy(
+                Path(filename).stem, Path(new_filename).stem
             )
-
+            if self._manifest.exists():
+                self._manifest.copy(filename, new_filename)
+            snapshots = self._snapshots_of("filenames", "auto_tag_counts", "tag_index")
+
+        if auto_tags:
+            self._update_auto_tag_counts(added=auto_tags)
+        self._update_tag_index(copied={filename: new_filename})
+        self._touched(snapshots)
+        make_thumbnails_in_background([self.img_path(new_filename)], self._thumbs_dir)
         return new_filename, has_txt_file
 
-    def import_images(self, from_path, remove_duplicates=False):
+    def import_images(
+        self,
+        from_path,
+        remove_duplicates=False,
+        retag=False,
+        max_hash_distance=0,
+        compress_level=PNG_COMPRESS_LEVEL,
+        optimize=False,
+    ):
+        """Import Images.
+
+        Images whose hash is within max_hash_distance bits of a larger (or same size) image,
+        either earlier in the import or already in the project, are duplicates. The images
+        are saved as .png files with the given compress_level and optimize settings (see
+        convert_for_import). Yields progress updates.
+        """
+        # Converted images are staged inside the project, so they can be moved into place.
+        staging_dir = tempfile.mkdtemp(prefix=".import-", dir=self._base_dir)
+        convert = partial(
+            convert_for_import, compress_level=compress_level, optimize=optimize
+        )
+        try:
+            yield from self._import_images(
+                staging_dir,
+                convert,
+                from_path,
+                remove_duplicates,
+                retag,
+                max_hash_distance,
+            )
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _import_images(
+        self,
+        staging_dir,
+        convert,
+        from_path,
+        remove_duplicates,
+        retag,
+        max_hash_distance,
+    ):
+        # Start a manifest for new projects (or older ones that don't have one yet), so
+        # the imported images can be added to it.
+        with self._files.write():
+            if not self._manifest.exists():
+                self._manifest.rebuild(self._img_dir, self._auto_tags_dir)
+
         candidates = {}
         files = valid_images_for_import(from_path)
-
-        # 1) Build a list of candidate images.
-        for i, f in enumerate(files):
-            img_path = os.path.join(from_path, f)
-
-            # Gather information about the image.
-            img = Image.open(img_path)
-            hash = imagehash.average_hash(img)
-            num_pixels = img.width * img.height
-
-            num_duplicates = 0
-            for c in candidates.values():
-                if c["hash"] == hash and c["num_pixels"] >= num_pixels:
-                    num_duplicates += 1
-
-            ignore_image = remove_duplicates and num_duplicates > 0
-            if not ignore_image:
-                candidates[img_path] = {
-                    "hash": hash,
-                    "num_pixels": num_pixels,
-                    "num_duplicates": num_duplicates,
-                    "new_filename_prefix": f"{hash}_{img.width}x{img.height}",
+        img_paths = [os.path.join(from_path, f) for f in files]
+
+        # Index the hashes, so we can look up near duplicates without comparing every image.
+        # The images already in the project have their hash and size in their filename.
+        hash_index = HashIndex()
+        for f in self.imgs:
+            info = parse_image_filename(f)
+            if info:
+                hash, width, height = info
+                hash_index.add(int(hash, 16), width * height)
+
+        # 1) Build a list of candidate images. Each image is only decoded once, to hash it and
+        # convert it to a .png in the staging directory. That's slow, so it's done across a
+        # pool of processes.
+        staged_paths = [
+            os.path.join(staging_dir, f"{i}.{IMG_EXT}") for i in range(len(img_paths))
+        ]
+        with ProcessPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+            chunksize = max(1, len(img_paths) // (IMPORT_WORKERS * 4))
+            img_infos = executor.map(
+                convert, img_paths, staged_paths, chunksize=chunksize
+            )
+            for i, (img_path, staged_path, (hash, width, height)) in enumerate(
+                zip(img_paths, staged_paths, img_infos)
+            ):
+                num_pixels = width * height
+
+                num_duplicates = 0
+                for _, dup_num_pixels in hash_index.find(
+                    int(hash, 16), max_hash_distance
+                ):
+                    if dup_num_pixels >= num_pixels:
+                        num_duplicates += 1
+
+                ignore_image = remove_duplicates and num_duplicates > 0
+                if not ignore_image:
+                    candidates[img_path] = {
+                        "hash": hash,
+                        "num_pixels": num_pixels,
+                        "num_duplicates": num_duplicates,
+                        "width": width,
+                        "height": height,
+                        "new_filename_prefix": f"{hash}_{width}x{height}",
+                        "staged_path": staged_path,
+                    }
+                    hash_index.add(int(hash, 16), num_pixels)
+                yield {
+                    "percentComplete": round((i + 1) / len(files) * 33),
+                    "totalFiles": len(files),
                 }
-            yield {
-                "percentComplete": round((i + 1) / len(files) * 33),
-                "totalFiles": len(files),
-            }
 
         num_candidates = len(candidates)
         if num_candidates == 0:
@@ -394,17 +866,36 @@ class Project:
             sorted(candidates.items(), key=lambda x: x[1]["new_filename_prefix"])
         )
         num_saved = 0
-        for img_path, data in candidates.items():
-            img = Image.open(img_path)
-            img = img.convert("RGB")
+        saved_img_paths = []
+        manifest_entries = []
+        for data in candidates.values():
             new_filename = choose_image_filename(
                 self._img_dir,
                 data["new_filename_prefix"],
                 data["num_duplicates"],
                 remove_duplicates,
+                index=self.filename_index,
             )
-            if not os.path.exists(os.path.join(self._img_dir, new_filename)):
-                img.save(os.path.join(self._img_dir, new_filename))
+            new_img_path = self.img_path(new_filename)
+            # Without remove_duplicates, the index has reserved a free filename for us.
+            # Otherwise, skip the image if its filename is already taken.
+            if not remove_duplicates or new_filename not in self.filename_index:
+                with self._files.write():
+                    os.replace(data["staged_path"], new_img_path)
+                    snapshots = self._snapshots_of("filenames")
+                self.filename_index.add(new_filename)
+                self._touched(snapshots)
+                saved_img_paths.append(new_img_path)
+                manifest_entries.append(
+                    ImageEntry(
+                        new_filename,
+                        data["width"],
+                        data["height"],
+                        data["hash"],
+                        False,
+                        [],
+                    )
+                )
             num_saved += 1
             yield {
                 "percentComplete": 33 + round(num_saved / num_candidates * 33),
@@ -413,18 +904,96 @@ class Project:
                 "lastImg": new_filename,
             }
 
+        with self._files.write():
+            self._manifest.add(manifest_entries)
+        self._update_tag_index(tags={entry.name: [] for entry in manifest_entries})
+
+        # Get the thumbnails ready while we're tagging.
+        make_thumbnails_in_background(saved_img_paths, self._thumbs_dir)
+
         # 3. Analyze the images and build the auto tags.
-        for i, _ in enumerate(
-            interrogate_directory(self._img_dir, self._auto_tags_dir)
+        # Only images without up to date auto tags are tagged, unless we're asked to retag.
+        # That can be more (or fewer) than we imported, so it's counted first for progress.
+        auto_tags = {}
+        to_tag = images_to_interrogate(self._img_dir, self._auto_tags_dir, force=retag)
+        for i, result in enumerate(
+            interrogate_directory(
+                self._img_dir, self._auto_tags_dir, image_paths=to_tag
+            )
         ):
+            auto_tags[Path(result["image_path"]).name] = [
+                tag.strip() for tag in result["tags"].split(",") if tag.strip()
+            ]
             yield {
-                "percentComplete": 66 + round(i / num_candidates * 33),
+                "percentComplete": 66 + round(i / len(to_tag) * 33),
                 "totalFiles": len(files),
                 "totalImages": num_candidates,
             }
+        with self.lock:
+            with self._files.write():
+                previous_auto_tags = {
+                    entry.name: entry.auto_tags
+                    for entry in self._manifest.images()
+                    if entry.name in auto_tags
+                }
+                self._manifest.set_auto_tags(auto_tags)
+                snapshots = self._snapshots_of("auto_tag_counts", "tag_index")
+            self._update_auto_tag_counts(
+                added=[tag for tags in auto_tags.values() for tag in tags],
+                removed=[tag for tags in previous_auto_tags.values() for tag in tags],
+            )
+            self._update_tag_index(auto_tags=auto_tags)
+            self._touched(snapshots)
         yield {"percentComplete": 100}
 
-        self._load()
+        self._forget("imgs", "auto_tags")
+
+    def rebuild_manifest(self):
+        # Fixes any drift between the manifest and the files on disk, i.e. after files were
+        # changed outside of the app.
+        with self._files.write():
+            self._manifest.rebuild(self._img_dir, self._auto_tags_dir)
+        self._forget("imgs", "auto_tags", "auto_tag_counts", "tag_index")
+
+    def rederive_auto_tags(
+        self, threshold: float = THRESHOLD, exclude_tags: list[str] = []
+    ) -> int:
+        """Rederive Auto Tags.
+
+        Rewrites the auto tags of every tagged image from the tagger's stored confidents,
+        i.e. after changing the threshold, without running the model again. Returns the
+        number of images that were updated.
+        """
+        with self.lock:
+            imgs = set(self.imgs)
+            with self._files.write():
+                previous_auto_tags = self._read_all_auto_tags()
+                auto_tags = {}
+                for result in rederive_auto_tags(
+                    self._auto_tags_dir, threshold, exclude_tags
+                ):
+                    fname = f"{Path(result['image_path']).stem}.{IMG_EXT}"
+                    if fname not in imgs:
+                        continue
+                    auto_tags[fname] = [
+                        tag.strip() for tag in result["tags"].split(",") if tag.strip()
+                    ]
+                if self._manifest.exists():
+                    self._manifest.set_auto_tags(auto_tags)
+                snapshots = self._snapshots_of("auto_tag_counts", "tag_index")
+
+            self._update_auto_tag_counts(
+                added=[tag for tags in auto_tags.values() for tag in tags],
+                removed=[
+                    tag
+                    for fname in auto_tags
+                    for tag in previous_auto_tags.get(fname, [])
+                ],
+            )
+            self._update_tag_index(auto_tags=auto_tags)
+            self._touched(snapshots)
+            self._forget("auto_tags")
+        return len(auto_tags)
 
     def _list_all_imgs(self) -> Tuple[list[str], list[str]]:
         # Return a tuple of (images, completed).
@@ -432,27 +1001,36 @@ class Project:
         imgs = []
         completed = []
 
-        if not os.path.exists(self._img_dir):
-            return [], []
-        for f in os.listdir(self._img_dir):
-            if f.endswith(IMG_EXT):
-                imgs.append(f)
-            elif (
-                f.endswith(".txt")
-                and os.path.getsize(os.path.join(self._img_dir, f)) > 0
-            ):
-                completed.append(f"{Path(f).stem}.{IMG_EXT}")
-        return sorted(imgs), sorted(completed)
+        with self._files.read():
+            if self._manifest.exists():
+                for name, is_completed in self._manifest.completed():
+                    imgs.append(name)
+                    if is_completed:
+                        completed.append(name)
+                return imgs, completed
+
+            if not os.path.exists(self._img_dir):
+                return [], []
+            for f in os.listdir(self._img_dir):
+                if f.endswith(IMG_EXT):
+                    imgs.append(f)
+                elif (
+                    f.endswith(".txt")
+                    and os.path.getsize(os.path.join(self._img_dir, f)) > 0
+                ):
+                    completed.append(f"{Path(f).stem}.{IMG_EXT}")
+            return sorted(imgs), sorted(completed)
 
     def _load_tags_from_file(self, path: Path) -> list[str]:
         tags = []
-        if os.path.exists(path):
-            with open(path, "r") as fp:
-                file_contents = fp.read()
-                if not file_contents.strip():
-                    return []
-                tags = [tag.strip() for tag in file_contents.split(",")]
-        return tags
+        with self._files.read():
+            if os.path.exists(path):
+                with open(path, "r") as fp:
+                    file_contents = fp.read()
+                    if not file_contents.strip():
+                        return []
+                    tags = [tag.strip() for tag in file_contents.split(",")]
+            return tags
 
     def _get_filtered_auto_tags(
         self, project_layout: list[TagCategory]
@@ -470,23 +1048,43 @@ class Project:
 
     def _get_all_auto_tags(self) -> dict[str, int]:
         tags: dict[str, int] = {}
+        for auto_tags in self._read_all_auto_tags().values():
+            for tag in auto_tags:
+                tags[tag] = tags.get(tag, 0) + 1
+        return tags
 
-        if not os.path.exists(self._auto_tags_dir):
-            return tags
+    def _read_all_auto_tags(self) -> dict[str, list[str]]:
+        # Return {filename: auto tags}.
+        with self._files.read():
+            if self._manifest.exists():
+                return {
+                    entry.name: entry.auto_tags for entry in self._manifest.images()
+                }
 
-        for f in os.listdir(self._auto_tags_dir):
-            if not f.endswith(".txt"):
-                continue
-            with open(os.path.join(self._auto_tags_dir, f), "r") as fp:
-                for tag in fp.read().split(","):
-                    tag = tag.strip()
-                    if not tag:
-                        continue
-                    tags[tag] = tags.get(tag, 0) + 1
-        return tags
+            if not os.path.exists(self._auto_tags_dir):
+                return {}
+
+            return {
+                f"{Path(f).stem}.{IMG_EXT}": read_auto_tags(
+                    os.path.join(self._auto_tags_dir, f)
+                )
+                for f in os.listdir(self._auto_tags_dir)
+                if f.endswith(".txt")
+            }
 
     def _analyze_auto_tags(self) -> list[TagInfo]:
-        tags = self._get_all_auto_tags()
+        # Only redo the analysis if the counts have changed since last time.
+        with self.lock:
+            tags = dict(self.auto_tag_counts)
+            version = self._auto_tag_counts_version
+            if self._analyzed_auto_tags and self._analyzed_auto_tags[0] == version:
+                return self._analyzed_auto_tags[1]
+        results = self._compress_auto_tags(tags)
+        with self.lock:
+            self._analyzed_auto_tags = (version, results)
+        return results
+
+    def _compress_auto_tags(self, tags: dict[str, int]) -> list[TagInfo]:
         if not tags:
             return []
 
@@ -495,17 +1093,16 @@ class Project:
 
         # Compress common suffixes to fill in tags, i.e. red head scarf -> {type} head scarf
         suffixes = common_suffixes(tags)
+        matching_suffixes = suffix_matcher(suffixes)
         tags_copy = tags.copy()
         fill_in_examples = {}
         for tag, count in tags_copy.items():
-            for ngram in suffixes.keys():
+            for ngram in matching_suffixes(tag):
                 # Here's a tag we can compress...
                 if tag.endswith(f" {ngram}"):
                     fill_in = "{type} " + ngram
                     tags[fill_in] = tags.get(fill_in, 0) + count
-                    fill_in_examples[fill_in] = fill_in_examples.get(fill_in, []) + [
-                        tag
-                    ]
+                    fill_in_examples.setdefault(fill_in, []).append(tag)
                     if tag in tags:
                         del tags[tag]
                 # Remove the extact match too, because it's covered by the fill in.
@@ -514,6 +1111,8 @@ class Project:
 
         # Remove any with 1 count.
         tags = {k: v for k, v in tags.items() if v > 1}
+        if not tags:
+            return []
 
         # Find the median count.
         counts = list(tags.values())
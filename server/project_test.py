@@ -1,11 +1,15 @@
 import os
 import tempfile
 import unittest
+from unittest import mock
 
 import imagehash
+import numpy as np
 from image import Crop
 from PIL import Image, ImageDraw
 from project import Project
+from thirdparty.tagger.run import ConfidenceStore
+from thumbnails import wait_for_thumbnails
 
 
 class TestProject(unittest.TestCase):
@@ -40,6 +44,236 @@ class TestProject(unittest.TestCase):
             (False, "Only alphanumeric characters, underscores, and hyphens allowed"),
         )
 
+    def test_lazy_load(self):
+        project = Project(self.project_name, self.temp_project_dir_path)
+        project.img_path("test.png")
+        self.assertNotIn("imgs", project.__dict__)
+
+        # Only the images are loaded.
+        self.assertEqual(project.completed, [])
+        self.assertIn("imgs", project.__dict__)
+        self.assertNotIn("auto_tags", project.__dict__)
+        self.assertNotIn("trigger_word", project.__dict__)
+
+        with self.assertRaises(AttributeError):
+            project.not_an_attribute
+
+    def test_manifest(self):
+        fname = "abcd_60x30_0.png"
+        Image.new("RGB", (60, 30)).save(self.project.img_path(fname))
+        self.project.rebuild_manifest()
+
+        # Files added behind the manifest's back aren't listed until it's rebuilt.
+        open(self.project.img_path("other.png"), "w").close()
+        self.assertEqual(self.project.imgs, [fname])
+
+        self.project.set_selected_image(fname)
+        self.project.save_txt_file("some, tags")
+        new_fname, _ = self.project.duplicate_image(fname)
+        self.project.delete_image(fname)
+        wait_for_thumbnails()
+
+        self.assertEqual(self.project.imgs, [new_fname])
+        self.assertEqual(self.project.completed, [new_fname])
+
+        self.project.rebuild_manifest()
+        self.assertEqual(self.project.imgs, [new_fname, "other.png"])
+
+    def test_auto_tag_counts(self):
+        fname = "abcd_60x30_0.png"
+        Image.new("RGB", (60, 30)).save(self.project.img_path(fname))
+        with open(self.project.auto_tags_dir().joinpath("abcd_60x30_0.txt"), "w") as f:
+            f.write("red, scarf")
+        self.assertEqual(self.project.auto_tag_counts, {"red": 1, "scarf": 1})
+
+        # The analysis is only redone when the counts change.
+        analyzed = self.project._analyze_auto_tags()
+        self.assertIs(self.project._analyze_auto_tags(), analyzed)
+
+        new_fname, _ = self.project.duplicate_image(fname)
+        self.assertEqual(self.project.auto_tag_counts, {"red": 2, "scarf": 2})
+        self.assertIsNot(self.project._analyze_auto_tags(), analyzed)
+
+        self.project.delete_image(fname)
+        self.project.delete_image(new_fname)
+        wait_for_thumbnails()
+        self.assertEqual(self.project.auto_tag_counts, {})
+        # The tagger never stored its confidents, so there's nothing to update.
+        self.assertEqual(sorted(os.listdir(self.project.auto_tags_dir())), [])
+
+        # The counts were kept up to date, so they don't need reloading.
+        self.project.refresh()
+        self.assertIn("auto_tag_counts", self.project.__dict__)
+
+    def test_changed_by_someone_else(self):
+        for i in range(2):
+            open(self.project.img_path(f"{i}.png"), "w").close()
+        self.project.rebuild_manifest()
+        self.project.find_images(["some tag"])
+
+        # Another project instance changes the images just after we delete one (and before
+        # we've finished updating ourselves).
+        update_tag_index = self.project._update_tag_index
+
+        def update_then_change(**kwargs):
+            update_tag_index(**kwargs)
+            open(self.project.img_path("2.png"), "w").close()
+            mtime = os.stat(self.project.img_dir()).st_mtime_ns + 1_000_000_000
+            os.utime(self.project.img_dir(), ns=(mtime, mtime))
+
+        with mock.patch.object(self.project, "_update_tag_index", update_then_change):
+            self.project.delete_image("0.png")
+        wait_for_thumbnails()
+
+        # Their change isn't mistaken for ours.
+        self.project.refresh()
+        self.assertNotIn("tag_index", self.project.__dict__)
+
+    def test_save_config(self):
+        config_path = self.project.base_dir().joinpath("config.json")
+        self.project.save({"triggerWord": "first"})
+        self.project.save({"triggerWord": "second"})
+
+        # Other instances see the changes before they're written.
+        project = Project(self.project_name, self.temp_project_dir_path)
+        self.assertEqual(project.trigger_word, "second")
+
+        self.project.flush()
+        with open(config_path, "r") as fp:
+            self.assertIn('"triggerWord": "second"', fp.read())
+
+    def test_images_page(self):
+        for i in range(5):
+            open(self.project.img_path(f"{i}.png"), "w").close()
+        for i in [1, 2]:
+            with open(self.project.img_path(f"{i}.txt"), "w") as f:
+                f.write("some, tags")
+
+        self.assertEqual(
+            self.project.images_page(1, 2), (["1.png", "2.png"], ["1.png", "2.png"], 5)
+        )
+        self.assertEqual(
+            self.project.images_page(0, 10, "completed"),
+            (["1.png", "2.png"], ["1.png", "2.png"], 2),
+        )
+        self.assertEqual(
+            self.project.images_page(2, 10, "uncompleted"), (["4.png"], [], 3)
+        )
+
+        summary = self.project.summary_to_dict()
+        self.assertEqual(summary["totalImages"], 5)
+        self.assertEqual(summary["totalCompleted"], 2)
+        self.assertEqual(summary["selectedImage"]["filename"], "0.png")
+        self.assertEqual(
+            summary["tagLayout"], [c.to_dict() for c in self.project.project_layout]
+        )
+        # The layout doesn't need the auto tags analysing.
+        self.assertNotIn("auto_tags", self.project.__dict__)
+        # Showing the default doesn't change the (shared) selected image.
+        self.assertEqual(self.project.selected_image, "")
+
+    def test_load_tags(self):
+        for i in range(3):
+            open(self.project.img_path(f"{i}.png"), "w").close()
+        with open(self.project.img_path("1.txt"), "w") as f:
+            f.write("some, tags")
+        with open(self.project.auto_tags_dir().joinpath("2.txt"), "w") as f:
+            f.write("red, scarf")
+        selected_image = self.project.selected_image
+
+        images, missing = self.project.load_tags(["1.png", "nope.png", "2.png"])
+        self.assertEqual(
+            images,
+            [
+                {"filename": "1.png", "tags": ["some", "tags"], "autoTags": []},
+                {"filename": "2.png", "tags": [], "autoTags": ["red", "scarf"]},
+            ],
+        )
+        self.assertEqual(missing, ["nope.png"])
+        self.assertEqual(self.project.selected_image, selected_image)
+
+    def test_save_txt_files(self):
+        for i in range(3):
+            open(self.project.img_path(f"{i}.png"), "w").close()
+        with open(self.project.img_path("2.txt"), "w") as f:
+            f.write("old, tags")
+        self.project.rebuild_manifest()
+
+        results = self.project.save_txt_files(
+            {"0.png": "new, tags", "2.png": "", "nope.png": "tags"}
+        )
+        self.assertEqual(
+            results, {"0.png": "", "2.png": "", "nope.png": "Image not found"}
+        )
+        with open(self.project.img_path("0.txt"), "r") as f:
+            self.assertEqual(f.read(), "new, tags")
+        self.assertFalse(os.path.exists(self.project.img_path("2.txt")))
+        self.assertEqual(self.project.completed, ["0.png"])
+        self.assertEqual(
+            sorted(os.listdir(self.project._img_dir)),
+            ["0.png", "0.txt", "1.png", "2.png"],
+        )
+
+        # Nothing needs reloading after a save.
+        self.project.filename_index
+        self.project.save_txt_files({"1.png": "more, tags"})
+        self.project.refresh()
+        self.assertIn("imgs", self.project.__dict__)
+        self.assertIn("filename_index", self.project.__dict__)
+        self.assertEqual(self.project.completed, ["0.png", "1.png"])
+
+    def test_find_images(self):
+        fname = "abcd_60x30_0.png"
+        Image.new("RGB", (60, 30)).save(self.project.img_path(fname))
+        open(self.project.img_path("other.png"), "w").close()
+        with open(self.project.img_path("abcd_60x30_0.txt"), "w") as f:
+            f.write("red, hat")
+        with open(self.project.auto_tags_dir().joinpath("other.txt"), "w") as f:
+            f.write("red, scarf")
+
+        self.assertEqual(self.project.find_images(["red"]), [fname, "other.png"])
+        self.assertEqual(
+            self.project.find_images(["red"], no_tags=["hat"]), ["other.png"]
+        )
+
+        # The index is kept up to date as the tags change.
+        self.project.save_txt_files({fname: "blue", "other.png": "hat"})
+        new_fname, _ = self.project.duplicate_image(fname)
+        self.project.delete_image(fname)
+        wait_for_thumbnails()
+        self.assertEqual(self.project.find_images(any_tags=["blue"]), [new_fname])
+        self.assertEqual(self.project.find_images(["hat", "scarf"]), ["other.png"])
+        self.project.refresh()
+        self.assertIn("tag_index", self.project.__dict__)
+
+    def test_rederive_auto_tags(self):
+        fname = "abcd_60x30_0.png"
+        Image.new("RGB", (60, 30)).save(self.project.img_path(fname))
+        with open(self.project.auto_tags_dir().joinpath("abcd_60x30_0.txt"), "w") as f:
+            f.write("red hair")
+        ConfidenceStore(self.project.auto_tags_dir()).add(
+            ["abcd_60x30_0"],
+            np.array([[0.9, 0.5, 0.2]]),
+            ["red_hair", "hat_(x)", "smile"],
+        )
+        self.project.rebuild_manifest()
+        self.assertEqual(self.project.auto_tag_counts, {"red hair": 1})
+        self.assertEqual(self.project.find_images(["hat \\(x\\)"]), [])
+
+        self.assertEqual(
+            self.project.rederive_auto_tags(0.4, exclude_tags=["red_hair"]), 1
+        )
+        with open(self.project.auto_tags_dir().joinpath("abcd_60x30_0.txt"), "r") as f:
+            self.assertEqual(f.read(), "hat \\(x\\)")
+        self.assertEqual(self.project.auto_tag_counts, {"hat \\(x\\)": 1})
+        self.assertEqual(self.project.find_images(["hat \\(x\\)"]), [fname])
+        self.assertEqual(self.project.find_images(["red hair"]), [])
+
+        # The manifest was updated too.
+        self.project.refresh()
+        self.project._forget("auto_tag_counts")
+        self.assertEqual(self.project.auto_tag_counts, {"hat \\(x\\)": 1})
+
     def test_list_all(self):
         self.assertIn(
             self.project_name, Project.list_all_projects(self.temp_project_dir_path)
@@ -65,6 +299,7 @@ class TestImportImages(unittest.TestCase):
         self.maxDiff = None
 
     def tearDown(self):
+        wait_for_thumbnails()
         self.temp_dir.cleanup()
         self.temp_project_dir.cleanup()
 
@@ -121,30 +356,23 @@ class TestImportImages(unittest.TestCase):
         self.assertEqual(
             import_status,
             [
+                # Both images are duplicates of the ones already in the project.
                 {"percentComplete": 16, "totalFiles": 2},
                 {"percentComplete": 33, "totalFiles": 2},
-                {
-                    "percentComplete": 66,
-                    "totalFiles": 2,
-                    "totalImages": 1,
-                    "lastImg": "0000000000000000_60x30_0.png",
-                },
-                {
-                    "percentComplete": 66,
-                    "totalFiles": 2,
-                    "totalImages": 1,
-                },
-                {
-                    "percentComplete": 99,
-                    "totalFiles": 2,
-                    "totalImages": 1,
-                },
                 {
                     "percentComplete": 100,
                 },
             ],
         )
 
+        # Retagging tags the images already in the project too, which are counted in the
+        # progress.
+        import_gen = project.import_images(self.temp_dir_path, retag=True)
+        self.assertEqual(
+            [status["percentComplete"] for status in import_gen],
+            [16, 33, 49, 66, 66, 74, 82, 91, 100],
+        )
+
 
 class TestEditImage(unittest.TestCase):
     def setUp(self):
@@ -186,6 +414,7 @@ class TestEditImage(unittest.TestCase):
         with open(self.new_kw_fname, "r") as f:
             self.assertEqual(f.read(), "test, image")
 
+        wait_for_thumbnails()
         self.temp_project_dir.cleanup()
 
     def test_rotate(self):
@@ -223,6 +452,18 @@ class TestEditImage(unittest.TestCase):
 
         self.new_kw_fname = self.project.img_path(f"{self.hash}_50x50_1.txt")
 
+    def test_thumbnail(self):
+        thumb_path = self.project.thumbnail_path(self.fname)
+        self.assertTrue(os.path.exists(thumb_path))
+
+        # Editing the image replaces its thumbnail.
+        output_img_name = self.project.edit_image(self.fname, 90, False, None)
+        wait_for_thumbnails()
+        self.assertFalse(os.path.exists(thumb_path))
+        self.assertTrue(
+            os.path.exists(self.project.thumbs_dir().joinpath(output_img_name))
+        )
+
 
 class TestAnalyzeAutoTags(unittest.TestCase):
 
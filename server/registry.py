@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+from consts import MAX_CACHED_PROJECTS
+from project import Project
+
+
+class ProjectRegistry:
+    """Keeps recently used projects loaded in memory.
+
+    Loading a project lists every image and re-reads all of the auto tags, so we don't want
+    to do that on every request. Any part of a cached project that has changed on disk is
+    reloaded the next time it's used.
+    """
+
+    def __init__(
+        self,
+        max_projects: int = MAX_CACHED_PROJECTS,
+        projects_dir: str | None = None,
+    ):
+        self._max_projects = max_projects
+        self._projects_dir = projects_dir
+        self._projects: OrderedDict[str, Project] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Project:
+        with self._lock:
+            project = self._projects.get(name)
+            if project is None:
+                # Cheap, because nothing is loaded until it's needed.
+                project = Project(name, self._projects_dir)
+                self._projects[name] = project
+            self._projects.move_to_end(name)
+            while len(self._projects) > self._max_projects:
+                self._projects.popitem(last=False)
+
+        project.refresh()
+        return project
+
+    def invalidate(self, name: str):
+        with self._lock:
+            self._projects.pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._projects.clear()
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._projects
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._projects)
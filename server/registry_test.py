@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from project import Project
+from registry import ProjectRegistry
+
+
+class TestProjectRegistry(unittest.TestCase):
+    def setUp(self):
+        # Temp projects directory.
+        self.temp_project_dir = tempfile.TemporaryDirectory()
+        self.temp_project_dir_path = self.temp_project_dir.name
+
+        for name in ["project1", "project2", "project3"]:
+            Project.create_new_project(name, projects_dir=self.temp_project_dir_path)
+
+        self.registry = ProjectRegistry(
+            max_projects=2, projects_dir=self.temp_project_dir_path
+        )
+
+    def tearDown(self):
+        self.temp_project_dir.cleanup()
+
+    def test_reuses_loaded_project(self):
+        project = self.registry.get("project1")
+        self.assertIs(self.registry.get("project1"), project)
+
+    def test_reloads_when_changed_on_disk(self):
+        project = self.registry.get("project1")
+        self.assertEqual(project.imgs, [])
+
+        # Add an image behind the project's back.
+        img_path = project.img_path("test.png")
+        open(img_path, "w").close()
+        mtime = os.stat(project.img_dir()).st_mtime_ns + 1_000_000_000
+        os.utime(project.img_dir(), ns=(mtime, mtime))
+
+        self.assertIs(self.registry.get("project1"), project)
+        self.assertEqual(project.imgs, ["test.png"])
+
+    def test_reloads_after_project_changes(self):
+        project = self.registry.get("project1")
+        open(project.img_path("test.png"), "w").close()
+        project.selected_image = "test.png"
+        self.assertEqual(project.completed, [])
+        project.save_txt_file("some, tags")
+
+        self.assertEqual(self.registry.get("project1").completed, ["test.png"])
+
+    def test_evicts_least_recently_used(self):
+        self.registry.get("project1")
+        self.registry.get("project2")
+        self.registry.get("project1")
+        self.registry.get("project3")
+
+        self.assertEqual(len(self.registry), 2)
+        self.assertIn("project1", self.registry)
+        self.assertNotIn("project2", self.registry)
+        self.assertIn("project3", self.registry)
+
+    def test_invalidate(self):
+        project = self.registry.get("project1")
+        self.registry.invalidate("project1")
+        self.assertNotIn("project1", self.registry)
+        self.assertIsNot(self.registry.get("project1"), project)
+
+
+if __name__ == "__main__":
+    unittest.main()
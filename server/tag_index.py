@@ -0,0 +1,129 @@
+from typing import Iterable, Iterator
+
+
+def bit_positions(bitmap: int) -> Iterator[int]:
+    # The positions of the set bits, lowest first.
+    bits = bin(bitmap)[:1:-1]
+    i = bits.find("1")
+    while i != -1:
+        yield i
+        i = bits.find("1", i + 1)
+
+
+def to_bitmap(positions: list[int]) -> int:
+    # Setting the bits in a bytearray first is much quicker than or-ing them into an int
+    # one at a time, since every int operation copies the whole bitmap.
+    bits = bytearray((max(positions) >> 3) + 1)
+    for i in positions:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, "little")
+
+
+class TagIndex:
+    """Which images have each tag, for filtering images by tag.
+
+    Each image is given a number, and each tag a bitmap (a Python int) with the bits for
+    the images that have it set. So a query is a few bitwise operations on the tags it
+    mentions, however many images there are. The tags and auto tags are kept separately,
+    so either can be updated on its own, but queries match both.
+    """
+
+    def __init__(self):
+        self._ids: dict[str, int] = {}
+        self._names: list[str | None] = []
+        self._all = 0
+
+        # {tag: bitmap} and {image id: tags}, for the tags and then the auto tags.
+        self._bitmaps: tuple[dict[str, int], dict[str, int]] = ({}, {})
+        self._image_tags: tuple[dict[int, set[str]], dict[int, set[str]]] = ({}, {})
+
+    def __len__(self) -> int:
+        return self._all.bit_count()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._ids
+
+    def add(self, name: str):
+        if name in self._ids:
+            return
+        # Numbers aren't reused, so a removed image's bits are never mistaken for a new one.
+        image_id = len(self._names)
+        self._ids[name] = image_id
+        self._names.append(name)
+        self._all |= 1 << image_id
+
+    def remove(self, name: str):
+        if name not in self._ids:
+            return
+        self.set_tags(name, [])
+        self.set_tags(name, [], auto=True)
+        image_id = self._ids.pop(name)
+        self._names[image_id] = None
+        self._all &= ~(1 << image_id)
+
+    def set_tags(self, name: str, tags: Iterable[str], auto: bool = False):
+        # Replaces the image's tags (or auto tags), adding the image if it's new.
+        self.set_many_tags({name: tags}, auto)
+
+    def set_many_tags(self, tags: dict[str, Iterable[str]], auto: bool = False):
+        # Like set_tags() for {name: tags}, but each tag's bitmap is only rebuilt once,
+        # which is much quicker when loading a whole project.
+        bitmaps = self._bitmaps[auto]
+        added: dict[str, list[int]] = {}
+        removed: dict[str, list[int]] = {}
+        for name, image_tags in tags.items():
+            self.add(name)
+            image_id = self._ids[name]
+            old_tags = self._image_tags[auto].pop(image_id, set())
+            new_tags = {tag for tag in map(str.strip, image_tags) if tag}
+            for tag in old_tags - new_tags:
+                removed.setdefault(tag, []).append(image_id)
+            for tag in new_tags - old_tags:
+                added.setdefault(tag, []).append(image_id)
+            if new_tags:
+                self._image_tags[auto][image_id] = new_tags
+
+        for tag, ids in removed.items():
+            bitmaps[tag] &= ~to_bitmap(ids)
+            if not bitmaps[tag]:
+                del bitmaps[tag]
+        for tag, ids in added.items():
+            bitmaps[tag] = bitmaps.get(tag, 0) | to_bitmap(ids)
+
+    def copy(self, name: str, new_name: str):
+        if name not in self._ids:
+            return
+        image_id = self._ids[name]
+        for auto in (False, True):
+            self.set_tags(new_name, self._image_tags[auto].get(image_id, []), auto)
+
+    def tags(self) -> set[str]:
+        return self._bitmaps[False].keys() | self._bitmaps[True].keys()
+
+    def query(
+        self,
+        all_tags: Iterable[str] = [],
+        any_tags: Iterable[str] = [],
+        no_tags: Iterable[str] = [],
+    ) -> list[str]:
+        """Returns the (sorted) images with all of all_tags, at least one of any_tags,
+        and none of no_tags. Empty lists are ignored."""
+        matches = self._all
+        for tag in all_tags:
+            matches &= self._bitmap(tag)
+
+        any_tags = list(any_tags)
+        if any_tags:
+            any_matches = 0
+            for tag in any_tags:
+                any_matches |= self._bitmap(tag)
+            matches &= any_matches
+
+        for tag in no_tags:
+            matches &= ~self._bitmap(tag)
+
+        return sorted(self._names[i] for i in bit_positions(matches))  # type: ignore
+
+    def _bitmap(self, tag: str) -> int:
+        tag = tag.strip()
+        return self._bitmaps[False].get(tag, 0) | self._bitmaps[True].get(tag, 0)
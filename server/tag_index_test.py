@@ -0,0 +1,51 @@
+import unittest
+
+from tag_index import TagIndex, bit_positions
+
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = TagIndex()
+        self.index.set_tags("a.png", ["red", "hat"])
+        self.index.set_tags("b.png", ["red"])
+        self.index.set_tags("b.png", ["scarf", "smiling"], auto=True)
+        self.index.set_tags("c.png", ["hat"], auto=True)
+        self.index.add("d.png")
+
+    def test_bit_positions(self):
+        self.assertEqual(list(bit_positions(0)), [])
+        self.assertEqual(list(bit_positions(0b101001)), [0, 3, 5])
+        self.assertEqual(list(bit_positions(1 << 1000)), [1000])
+
+    def test_query(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.query(["red"]), ["a.png", "b.png"])
+        self.assertEqual(self.index.query(["red", "hat"]), ["a.png"])
+        self.assertEqual(
+            self.index.query(any_tags=["hat", "scarf"]), ["a.png", "b.png", "c.png"]
+        )
+        self.assertEqual(self.index.query(no_tags=["red"]), ["c.png", "d.png"])
+        self.assertEqual(
+            self.index.query(["red"], ["scarf", "smiling"], ["hat"]), ["b.png"]
+        )
+        self.assertEqual(self.index.query(["unknown"]), [])
+        self.assertEqual(self.index.query(), ["a.png", "b.png", "c.png", "d.png"])
+
+    def test_update(self):
+        self.index.set_tags("a.png", ["blue"])
+        self.assertEqual(self.index.query(["red"]), ["b.png"])
+        self.assertEqual(self.index.query(["blue"]), ["a.png"])
+
+        self.index.copy("b.png", "e.png")
+        self.assertEqual(self.index.query(["red", "scarf"]), ["b.png", "e.png"])
+
+        self.index.remove("b.png")
+        self.index.remove("not_there.png")
+        self.assertNotIn("b.png", self.index)
+        self.assertEqual(self.index.query(["red"]), ["e.png"])
+        self.assertEqual(self.index.query(), ["a.png", "c.png", "d.png", "e.png"])
+        self.assertEqual(self.index.tags(), {"blue", "red", "hat", "scarf", "smiling"})
+
+
+if __name__ == "__main__":
+    unittest.main()
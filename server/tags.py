@@ -1,29 +1,137 @@
+from collections import deque
+from typing import Callable
+
+
 def common_suffixes(tags: dict[str, int]) -> dict[str, int]:
     # Build a list of common suffixes.
     # These can be a single word or multiple words. Therefore, we need to look at ngrams.
     # Example 1: "red head scarf", "blue head scarf", "yellow head scarf" -> "head scarf"
     # Example 2: "wide angle", "closeup angle" -> "angle"
 
+    # Count the suffixes with a trie of the tags' words, last word first. Each node is a
+    # suffix, and counts the tags that end with it.
+    root = _TrieNode()
     suffixes = {}
     for tag in tags.keys():
         words = tag.split(" ")
-        for i in range(1, len(words)):
-            suffix = " ".join(words[i:])
-            suffixes[suffix] = suffixes.get(suffix, 0) + 1
+        node = root
+        path = []
+        for word in reversed(words[1:]):
+            node = node.child(word)
+            node.count += 1
+            path.append(node)
+        # Record the suffixes longest first, to keep the same order as the tags.
+        for i, node in enumerate(reversed(path), start=1):
+            if node.suffix is None:
+                node.suffix = " ".join(words[i:])
+                suffixes[node.suffix] = node
+    suffixes = {suffix: node.count for suffix, node in suffixes.items()}
 
     # If a suffix is already contained in a longer suffix, remove it.
-    suffixes_copy = suffixes.copy()
-    for suffix, s_count in suffixes_copy.items():
-        for other_suffix, os_count in suffixes_copy.items():
-            if (
-                len(suffix) < len(other_suffix)
-                and suffix in other_suffix
-                and s_count <= os_count
-            ):
-                del suffixes[suffix]
-                break
+    contained = _contained_in_longer(suffixes)
+    suffixes = {k: v for k, v in suffixes.items() if k not in contained}
 
     # Remove any that have count < 2
     suffixes = {k: v for k, v in suffixes.items() if v >= 2}
 
     return suffixes
+
+
+def suffix_matcher(suffixes: dict[str, int]) -> Callable[[str], list[str]]:
+    """Suffix Matcher.
+
+    Returns a function that finds the suffixes (from common_suffixes) a tag ends with, or
+    is, in the order of suffixes. Only looks at the tag's words, rather than comparing the
+    tag with every suffix.
+    """
+    root = _TrieNode()
+    order = {}
+    for i, suffix in enumerate(suffixes.keys()):
+        node = root
+        for word in reversed(suffix.split(" ")):
+            node = node.child(word)
+        node.suffix = suffix
+        order[suffix] = i
+
+    def lookup(tag: str) -> list[str]:
+        matches = []
+        node = root
+        for word in reversed(tag.split(" ")):
+            node = node.children.get(word)
+            if node is None:
+                break
+            if node.suffix is not None:
+                matches.append(node.suffix)
+        return sorted(matches, key=order.__getitem__)
+
+    return lookup
+
+
+class _TrieNode:
+    __slots__ = ("children", "count", "suffix")
+
+    def __init__(self):
+        self.children: dict[str, _TrieNode] = {}
+        self.count = 0
+        self.suffix: str | None = None
+
+    def child(self, key: str) -> "_TrieNode":
+        node = self.children.get(key)
+        if node is None:
+            node = self.children[key] = _TrieNode()
+        return node
+
+
+def _contained_in_longer(suffixes: dict[str, int]) -> set[str]:
+    # The suffixes that are a substring of a longer suffix with the same or higher count.
+    # Rather than comparing every pair, this builds an Aho-Corasick automaton of all the
+    # suffixes, and runs each suffix through it to find the ones it contains.
+    patterns = list(suffixes.keys())
+    goto: list[dict[str, int]] = [{}]
+    pattern_at = [-1]
+    for i, pattern in enumerate(patterns):
+        state = 0
+        for ch in pattern:
+            next_state = goto[state].get(ch)
+            if next_state is None:
+                next_state = goto[state][ch] = len(goto)
+                goto.append({})
+                pattern_at.append(-1)
+            state = next_state
+        pattern_at[state] = i
+
+    # fail: the longest proper suffix of the state that's also a state.
+    # output: the next state down the fail links that's a pattern (or -1).
+    fail = [0] * len(goto)
+    output = [-1] * len(goto)
+    queue = deque(goto[0].values())
+    for state in queue:
+        output[state] = 0 if pattern_at[0] >= 0 else -1
+    while queue:
+        state = queue.popleft()
+        for ch, next_state in goto[state].items():
+            queue.append(next_state)
+            if state == 0:
+                continue
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            f = goto[f].get(ch, 0)
+            fail[next_state] = f
+            output[next_state] = f if pattern_at[f] >= 0 else output[f]
+
+    contained = set()
+    for text in patterns:
+        count = suffixes[text]
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            match = state if pattern_at[state] >= 0 else output[state]
+            while match != -1:
+                pattern = patterns[pattern_at[match]]
+                if len(pattern) < len(text) and suffixes[pattern] <= count:
+                    contained.add(pattern)
+                match = output[match] if match else -1
+    return contained
@@ -1,6 +1,6 @@
 import unittest
 
-from tags import common_suffixes
+from tags import common_suffixes, suffix_matcher
 
 
 class TestCommonSuffixes(unittest.TestCase):
@@ -38,6 +38,27 @@ class TestCommonSuffixes(unittest.TestCase):
         expected_suffixes = {}
         self.assertEqual(common_suffixes(tags), expected_suffixes)
 
+    def test_common_suffixes_contained(self):
+        # Suffixes inside a longer suffix are removed, even part way through a word.
+        tags = {
+            "red car": 1,
+            "blue car": 1,
+            "red head scarf": 1,
+            "blue head scarf": 1,
+            "big red head scarf": 1,
+        }
+        expected_suffixes = {"head scarf": 3}
+        self.assertEqual(common_suffixes(tags), expected_suffixes)
+
+
+class TestSuffixMatcher(unittest.TestCase):
+    def test_suffix_matcher(self):
+        matching_suffixes = suffix_matcher({"big image": 2, "image": 3, "angle": 2})
+        self.assertEqual(matching_suffixes("really big image"), ["big image", "image"])
+        self.assertEqual(matching_suffixes("image"), ["image"])
+        self.assertEqual(matching_suffixes("wide angle"), ["angle"])
+        self.assertEqual(matching_suffixes("wideangle"), [])
+
 
 if __name__ == "__main__":
     unittest.main()
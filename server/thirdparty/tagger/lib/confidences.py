@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+DATA_FILE = "confidences.f16"
+HEADER_FILE = "confidences.json"
+LOG_FILE = "confidences.log"
+
+# Write the logged changes to the header once the log gets this big.
+MAX_LOG_BYTES = 1024 * 1024
+
+# Rows copied at a time when compacting, so the data file isn't read all at once.
+COMPACT_CHUNK_ROWS = 4096
+
+# Guards changes to a directory's store, shared by every ConfidenceStore for it.
+_dir_locks: Dict[str, threading.Lock] = {}
+_dir_locks_lock = threading.Lock()
+
+
+def _dir_lock(dir_path) -> threading.Lock:
+    key = os.path.abspath(dir_path)
+    with _dir_locks_lock:
+        if key not in _dir_locks:
+            _dir_locks[key] = threading.Lock()
+        return _dir_locks[key]
+
+
+class ConfidenceStore:
+    """Raw tag confidents for every image the tagger has seen.
+
+    Rows of float16 confidents are appended to a data file (one row per interrogation),
+    which is memory-mapped for reading. A JSON header lists the tag names for the columns
+    and maps each image (by file stem) to its latest row. Changes to that map are appended
+    to a log rather than rewriting the header each time, and are only folded into the
+    header by compact() (i.e. at the end of a tagging run), which also drops the rows that
+    are no longer used.
+    """
+
+    def __init__(self, dir_path) -> None:
+        self.data_path = os.path.join(dir_path, DATA_FILE)
+        self.header_path = os.path.join(dir_path, HEADER_FILE)
+        self.log_path = os.path.join(dir_path, LOG_FILE)
+        # Compacting writes these first, see _compact().
+        self._new_data_path = f"{self.data_path}.tmp"
+        self._new_header_path = f"{self.header_path}.new"
+        self._lock = _dir_lock(dir_path)
+        # Loaded the first time they're needed, so changes don't have to read anything.
+        self._tag_names: List[str] | None = None
+        self._rows: Dict[str, int] = {}
+
+    @property
+    def tag_names(self) -> List[str]:
+        if self._tag_names is None:
+            with self._lock:
+                self._load()
+        return self._tag_names  # type: ignore
+
+    @property
+    def rows(self) -> Dict[str, int]:
+        self.tag_names
+        return self._rows
+
+    def _load(self) -> None:
+        # Read the header, then replay any changes logged since it was written.
+        self._finish_compacting()
+        self._tag_names = []
+        self._rows = {}
+        if os.path.exists(self.header_path):
+            with open(self.header_path, "r", encoding="utf-8") as fp:
+                header = json.load(fp)
+                self._tag_names = header["tags"]
+                self._rows = header["rows"]
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        change = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Only the last line can be half written (i.e. after a crash).
+                        break
+                    self._apply(change)
+
+    def _apply(self, change: list) -> None:
+        op, stem, *args = change
+        if op == "add":
+            self._rows[stem] = args[0]
+        elif op == "copy" and stem in self._rows:
+            self._rows[args[0]] = self._rows[stem]
+        elif op == "rename" and stem in self._rows:
+            self._rows[args[0]] = self._rows.pop(stem)
+        elif op == "remove":
+            self._rows.pop(stem, None)
+
+    def _log(self, changes: List[list]) -> None:
+        # Call with the lock held.
+        with open(self.log_path, "a", encoding="utf-8") as fp:
+            fp.write("".join(json.dumps(change) + "\n" for change in changes))
+        if self._tag_names is not None:
+            for change in changes:
+                self._apply(change)
+        if os.path.getsize(self.log_path) > MAX_LOG_BYTES:
+            self._compact()
+
+    def _save_header(self, path: str) -> None:
+        # Write to a temp file first, so the header is never left half written.
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump({"tags": self._tag_names, "rows": self._rows}, fp)
+        os.replace(tmp_path, path)
+
+    def compact(self) -> None:
+        """Writes the logged changes to the header, and starts a new log."""
+        with self._lock:
+            # Nothing's changed if nothing was logged.
+            if os.path.exists(self.log_path):
+                self._compact()
+
+    def _compact(self) -> None:
+        # Reload first, to pick up changes logged through other stores.
+        self._load()
+
+        # Only keep the rows that are still used, i.e. not the old rows of retagged images
+        # or the rows of deleted ones.
+        used_rows = sorted(set(self._rows.values()))
+        if len(used_rows) < self._num_rows():
+            data = self._map()
+            with open(self._new_data_path, "wb") as fp:
+                for start in range(0, len(used_rows), COMPACT_CHUNK_ROWS):
+                    chunk = used_rows[start : start + COMPACT_CHUNK_ROWS]
+                    fp.write(np.ascontiguousarray(data[chunk]).tobytes())
+            # Unmapped before it's replaced (which fails on Windows otherwise).
+            del data
+            new_rows = {row: i for i, row in enumerate(used_rows)}
+            self._rows = {stem: new_rows[row] for stem, row in self._rows.items()}
+
+        # The new header is the commit point. If we crash after it's written, the next
+        # load finishes the job, so the header never points at rows that have moved.
+        self._save_header(self._new_header_path)
+        self._finish_compacting()
+
+    def _finish_compacting(self) -> None:
+        # Call with the lock held.
+        if not os.path.exists(self._new_header_path):
+            # Any new data is from a compaction that didn't get as far as its header.
+            if os.path.exists(self._new_data_path):
+                os.remove(self._new_data_path)
+            return
+        if os.path.exists(self._new_data_path):
+            os.replace(self._new_data_path, self.data_path)
+        # The log's changes are in the new header, and its rows may have moved.
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        os.replace(self._new_header_path, self.header_path)
+
+    def num_rows(self) -> int:
+        with self._lock:
+            if self._tag_names is None:
+                self._load()
+            return self._num_rows()
+
+    def _num_rows(self) -> int:
+        if not self._tag_names or not os.path.exists(self.data_path):
+            return 0
+        return os.path.getsize(self.data_path) // (len(self._tag_names) * 2)
+
+    def confidents(self) -> np.ndarray:
+        """All the rows, memory-mapped. Use rows to find an image's row."""
+        with self._lock:
+            if self._tag_names is None:
+                self._load()
+            return self._map()
+
+    def _map(self) -> np.ndarray:
+        # Call with the lock held, as compacting replaces the data file.
+        num_rows = self._num_rows()
+        if num_rows == 0:
+            return np.empty((0, len(self._tag_names or [])), dtype=np.float16)
+        return np.memmap(
+            self.data_path,
+            dtype=np.float16,
+            mode="r",
+            shape=(num_rows, len(self._tag_names or [])),
+        )
+
+    def get(self, stem: str) -> np.ndarray | None:
+        with self._lock:
+            # Reload, in case the rows were moved by another store compacting.
+            self._load()
+            row = self._rows.get(stem)
+            if row is None:
+                return None
+            return np.array(self._map()[row])
+
+    def add(self, stems: List[str], confidents: np.ndarray, tag_names: List[str]):
+        with self._lock:
+            if self._tag_names is None:
+                self._load()
+            if tag_names != self._tag_names:
+                # A different model, so the old rows don't line up any more.
+                self._tag_names = list(tag_names)
+                self._rows = {}
+                for path in (self.data_path, self.log_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._save_header(self.header_path)
+
+            first_row = self._num_rows()
+            with open(self.data_path, "ab") as fp:
+                fp.write(np.ascontiguousarray(confidents, dtype=np.float16).tobytes())
+            self._log([["add", stem, first_row + i] for i, stem in enumerate(stems)])
+
+    def _change(self, changes: List[list]) -> None:
+        with self._lock:
+            # There's nothing to change if the tagger has never stored anything here.
+            if os.path.exists(self.header_path):
+                self._log(changes)
+
+    def rename(self, old_stem: str, new_stem: str):
+        self._change([["rename", old_stem, new_stem]])
+
+    def copy(self, stem: str, new_stem: str):
+        # The copy can share the row, because rows are never modified.
+        self._change([["copy", stem, new_stem]])
+
+    def remove(self, stem: str):
+        self._change([["remove", stem]])
+
+    def above_threshold(
+        self, threshold: float, exclude_tags: List[str] = []
+    ) -> Dict[str, Dict[str, float]]:
+        """Above Threshold.
+
+        Tags with a confident >= threshold for every image, highest confident first. The
+        confidents are stored as float16, so ones within ~0.001 of the threshold may round
+        either way.
+        """
+        with self._lock:
+            # Reload, in case the rows were moved by another store compacting.
+            self._load()
+            stems = list(self._rows.keys())
+            if not stems:
+                return {}
+            tag_names = list(self._tag_names or [])
+            # Indexing copies the rows, so the data file can be replaced afterwards.
+            confidents = self._map()[[self._rows[stem] for stem in stems]]
+
+        confidents = confidents.astype(np.float32)
+        if exclude_tags:
+            excluded = np.isin(tag_names, exclude_tags)
+            confidents[:, excluded] = -np.inf
+
+        results = {}
+        above = confidents >= threshold
+        for stem, image_confidents, image_above in zip(stems, confidents, above):
+            indexes = np.flatnonzero(image_above)
+            indexes = indexes[np.argsort(-image_confidents[indexes], kind="stable")]
+            results[stem] = {tag_names[i]: float(image_confidents[i]) for i in indexes}
+        return results
@@ -1,17 +1,26 @@
 import json
 import os
 import re
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Dict, List, Tuple
 
 import numpy as np
 import pandas as pd
 from huggingface_hub import hf_hub_download
-from numpy import asarray, exp, expand_dims, float32
+from numpy import asarray, exp, float32
 from PIL import Image
 
 tag_escape_pattern = re.compile(r"([\\()])")
 
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
 from . import dbimutils
 
 
@@ -62,39 +71,265 @@ class Interrogator:
 
         return tags
 
+    def postprocess_confidents(
+        self,
+        confidents: np.ndarray,
+        threshold=0.35,
+        exclude_tags: List[str] = [],
+        sort_by_alphabetical_order=False,
+        add_confident_as_weight=False,
+        replace_underscore=False,
+        replace_underscore_excludes: List[str] = [],
+        escape_tag=False,
+        top_k: int | None = None,
+    ) -> Dict[str, float]:
+        """Postprocess Confidents.
+
+        Same as postprocess_tags(), but works directly on one image's tag confidents (as
+        returned by predict()), which is much faster than building a dict of every tag.
+        If top_k is set, only the top_k most confident tags are kept.
+        """
+        # Compare as float64, otherwise numpy rounds the threshold to float32.
+        indexes = np.flatnonzero(confidents.astype(np.float64) >= threshold)
+        if exclude_tags:
+            excluded = self._tag_indexes(tuple(exclude_tags))
+            indexes = indexes[~np.isin(indexes, excluded)]
+
+        if top_k is not None and len(indexes) > top_k:
+            top = np.argpartition(-confidents[indexes], top_k - 1)[:top_k]
+            indexes = indexes[np.sort(top)]
+
+        # Stable sorts, so ties stay in tag order like postprocess_tags().
+        if sort_by_alphabetical_order:
+            order = np.argsort(self._tag_name_array()[indexes], kind="stable")
+        else:
+            order = np.argsort(-confidents[indexes], kind="stable")
+        indexes = indexes[order]
+
+        names = self._processed_tag_names(
+            replace_underscore, tuple(replace_underscore_excludes), escape_tag
+        )
+        tags = {}
+        for i in indexes.tolist():
+            confident = float(confidents[i])
+            new_tag = names[i]
+            if add_confident_as_weight:
+                new_tag = f"({new_tag}:{confident})"
+            tags[new_tag] = confident
+        return tags
+
+    def _tag_name_array(self) -> np.ndarray:
+        if "names" not in self._tag_tables:
+            self._tag_tables["names"] = np.array(self.tag_names)
+        return self._tag_tables["names"]
+
+    def _tag_indexes(self, tags: Tuple[str, ...]) -> np.ndarray:
+        key = ("indexes", tags)
+        if key not in self._tag_tables:
+            self._tag_tables[key] = np.flatnonzero(
+                np.isin(self._tag_name_array(), tags)
+            )
+        return self._tag_tables[key]
+
+    def _processed_tag_names(
+        self,
+        replace_underscore: bool,
+        replace_underscore_excludes: Tuple[str, ...],
+        escape_tag: bool,
+    ) -> List[str]:
+        # Every tag name with the replacements applied, built once per model and options.
+        key = ("processed", replace_underscore, replace_underscore_excludes, escape_tag)
+        if key not in self._tag_tables:
+            names = []
+            for tag in self.tag_names:
+                new_tag = tag
+                if replace_underscore and tag not in replace_underscore_excludes:
+                    new_tag = new_tag.replace("_", " ")
+                if escape_tag:
+                    new_tag = tag_escape_pattern.sub(r"\\\1", new_tag)
+                names.append(new_tag)
+            self._tag_tables[key] = names
+        return self._tag_tables[key]
+
     def __init__(self, name: str) -> None:
         from onnxruntime import InferenceSession
 
         self.model: InferenceSession | None = None
         self.tags = None
+        self.rating_names: List[str] = []
+        self.tag_names: List[str] = []
+        # Lookup tables derived from tag_names, see postprocess_confidents().
+        self._tag_tables: Dict = {}
         self.name = name
         self.providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
 
+        # Session options, see configure_session().
+        self.intra_op_num_threads = 0
+        self.inter_op_num_threads = 0
+        self.graph_optimization_level = "all"
+
+        # The model is unloaded after it's been idle for this many seconds (None = never).
+        self.idle_timeout: float | None = None
+        self._idle_timer: threading.Timer | None = None
+        self._num_users = 0
+        self._lock = threading.RLock()
+
+        # Model and tags paths, so we only check the hub once.
+        self._downloaded: Tuple | None = None
+
     def load(self):
         raise NotImplementedError()
 
     def unload(self) -> bool:
         unloaded = False
 
-        if hasattr(self, "model") and self.model is not None:
-            del self.model
-            unloaded = True
-            print(f"Unloaded {self.name}")
+        with self._lock:
+            if getattr(self, "model", None) is not None:
+                self.model = None
+                unloaded = True
+                print(f"Unloaded {self.name}")
 
-        if hasattr(self, "tags"):
-            del self.tags
+            self.tags = None
 
         return unloaded
 
+    def configure_session(
+        self,
+        intra_op_num_threads=0,
+        inter_op_num_threads=0,
+        graph_optimization_level="all",
+        idle_timeout: float | None = None,
+    ) -> None:
+        """Configure Session.
+
+        Thread counts of 0 let onnxruntime choose. graph_optimization_level is one of
+        GRAPH_OPTIMIZATION_LEVELS. Takes effect the next time the model is loaded.
+        """
+        if graph_optimization_level not in GRAPH_OPTIMIZATION_LEVELS:
+            raise ValueError(
+                f"Invalid graph optimization level: {graph_optimization_level}"
+            )
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+        self.graph_optimization_level = graph_optimization_level
+        self.idle_timeout = idle_timeout
+
+    def ensure_loaded(self) -> None:
+        # i.e. to warm the model up before it's needed.
+        with self.in_use():
+            pass
+
+    @contextmanager
+    def in_use(self):
+        """Loads the model if needed, and keeps it loaded until the block exits.
+
+        The idle timeout starts once nothing is using the model.
+        """
+        with self._lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if not self.is_loaded():
+                self.load()
+            self._num_users += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._num_users -= 1
+                if self._num_users == 0 and self.idle_timeout is not None:
+                    self._idle_timer = threading.Timer(
+                        self.idle_timeout, self._unload_if_idle
+                    )
+                    self._idle_timer.daemon = True
+                    self._idle_timer.start()
+
+    def _unload_if_idle(self) -> None:
+        with self._lock:
+            if self._num_users == 0:
+                self.unload()
+
+    def _download_once(self) -> Tuple:
+        if self._downloaded is None:
+            self._downloaded = self.download()
+        return self._downloaded
+
+    def _create_session(self, model_path):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_num_threads
+        options.inter_op_num_threads = self.inter_op_num_threads
+        options.graph_optimization_level = getattr(
+            onnxruntime.GraphOptimizationLevel,
+            GRAPH_OPTIMIZATION_LEVELS[self.graph_optimization_level],
+        )
+        return onnxruntime.InferenceSession(
+            str(model_path), sess_options=options, providers=self.providers
+        )
+
     def use_cpu(self) -> None:
         self.providers = ["CPUExecutionProvider"]
 
+    def is_loaded(self) -> bool:
+        return getattr(self, "model", None) is not None
+
+    def preprocess(self, image: Image.Image) -> np.ndarray:
+        """Converts an image into the model's input, without the batch dimension."""
+        raise NotImplementedError()
+
+    def predict(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Runs the model on a batch of preprocessed images.
+
+        Returns the rating and tag confidents, with one row per image. The columns line up
+        with rating_names and tag_names.
+        """
+        raise NotImplementedError()
+
     def interrogate(
         self, image: Image.Image
     ) -> Tuple[
         Dict[str, float], Dict[str, float]  # rating confidents  # tag confidents
     ]:
-        raise NotImplementedError()
+        return self.interrogate_batch([image])[0]
+
+    def interrogate_batch(
+        self, images: List[Image.Image]
+    ) -> List[Tuple[Dict[str, float], Dict[str, float]]]:
+        """Interrogates all the images with a single model run."""
+        if not images:
+            return []
+
+        with self.in_use():
+            return self.interrogate_preprocessed(
+                np.stack([self.preprocess(image) for image in images])
+            )
+
+    def interrogate_preprocessed(
+        self, batch: np.ndarray
+    ) -> List[Tuple[Dict[str, float], Dict[str, float]]]:
+        """Like interrogate_batch(), for images that have already been preprocessed."""
+        ratings, tags = self.predict(batch)
+        return [
+            (
+                dict(zip(self.rating_names, image_ratings.tolist())),
+                dict(zip(self.tag_names, image_tags.tolist())),
+            )
+            for image_ratings, image_tags in zip(ratings, tags)
+        ]
+
+    def _run(self, batch: np.ndarray) -> np.ndarray:
+        assert self.model is not None
+        input_ = self.model.get_inputs()[0]
+        output = self.model.get_outputs()[0]
+
+        # Some models are exported with a fixed batch size (usually 1), so split the batch up.
+        batch_size = input_.shape[0] if isinstance(input_.shape[0], int) else len(batch)
+        results = [
+            self.model.run([output.name], {input_.name: batch[i : i + batch_size]})[0]
+            for i in range(0, len(batch), batch_size)
+        ]
+        return np.concatenate(results)
 
 
 class WaifuDiffusionInterrogator(Interrogator):
@@ -118,25 +353,19 @@ class WaifuDiffusionInterrogator(Interrogator):
         return model_path, tags_path
 
     def load(self) -> None:
-        model_path, tags_path = self.download()
-
-        from onnxruntime import InferenceSession
+        model_path, tags_path = self._download_once()
 
-        self.model = InferenceSession(str(model_path), providers=self.providers)
+        self.model = self._create_session(model_path)
 
         print(f"Loaded {self.name} model from {model_path}")
 
         self.tags = pd.read_csv(tags_path)
+        names = self.tags["name"].tolist()
+        self.rating_names = names[:4]
+        self.tag_names = names[4:]
+        self._tag_tables = {}
 
-    def interrogate(
-        self, image: Image.Image
-    ) -> Tuple[
-        Dict[str, float], Dict[str, float]  # rating confidents  # tag confidents
-    ]:
-        # init model
-        if not hasattr(self, "model") or self.model is None:
-            self.load()
-
+    def preprocess(self, image: Image.Image) -> np.ndarray:
         # code for converting the image and running the model is taken from the link below
         # thanks, SmilingWolf!
         # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
@@ -157,24 +386,14 @@ class WaifuDiffusionInterrogator(Interrogator):
 
         image_array = dbimutils.make_square(image_array, height)
         image_array = dbimutils.smart_resize(image_array, height)
-        image_array = image_array.astype(np.float32)
-        image_array = np.expand_dims(image_array, 0)
+        return image_array.astype(np.float32)
 
-        # evaluate model
-        input_name = self.model.get_inputs()[0].name
-        label_name = self.model.get_outputs()[0].name
-        confidents = self.model.run([label_name], {input_name: image_array})[0]
-
-        tags = self.tags[:][["name"]]
-        tags["confidents"] = confidents[0]
+    def predict(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        confidents = self._run(batch)
 
         # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
-
         # rest are regular tags
-        tags = dict(tags[4:].values)
-
-        return ratings, tags
+        return confidents[:, :4], confidents[:, 4:]
 
 
 class MLDanbooruInterrogator(Interrogator):
@@ -205,45 +424,32 @@ class MLDanbooruInterrogator(Interrogator):
         return model_path, tags_path
 
     def load(self) -> None:
-        model_path, tags_path = self.download()
-
-        from onnxruntime import InferenceSession
+        model_path, tags_path = self._download_once()
 
-        self.model = InferenceSession(model_path, providers=self.providers)
+        self.model = self._create_session(model_path)
         print(f"Loaded {self.name} model from {model_path}")
 
         with open(tags_path, "r", encoding="utf-8") as filen:
             self.tags = json.load(filen)
+        self.tag_names = list(self.tags)
+        self._tag_tables = {}
 
-    def interrogate(
-        self, image: Image.Image
-    ) -> Tuple[
-        Dict[str, float], Dict[str, float]  # rating confidents  # tag confidents
-    ]:
-        # init model
-        if self.model is None:
-            self.load()
-
+    def preprocess(self, image: Image.Image) -> np.ndarray:
         image = dbimutils.fill_transparent(image)
         image = dbimutils.resize(image, 448)  # TODO CUSTOMIZE
 
         x = asarray(image, dtype=float32) / 255
-        # HWC -> 1CHW
-        x = x.transpose((2, 0, 1))
-        x = expand_dims(x, 0)
+        # HWC -> CHW
+        return x.transpose((2, 0, 1))
 
-        assert self.model is not None
-        input_ = self.model.get_inputs()[0]
-        output = self.model.get_outputs()[0]
-        # evaluate model
-        (y,) = self.model.run([output.name], {input_.name: x})
+    def predict(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        y = self._run(batch)
 
         # Softmax
         y = 1 / (1 + exp(-y))
 
-        assert self.tags is not None
-        tags = {tag: float(conf) for tag, conf in zip(self.tags, y.flatten())}
-        return {}, tags
+        # No ratings.
+        return np.empty((len(y), 0), dtype=y.dtype), y
 
     def large_batch_interrogate(self, images: List, dry_run=False) -> str:
         raise NotImplementedError()
@@ -2,13 +2,25 @@ MODEL = "wd-v1-4-convnext-tagger.v3"
 THRESHOLD = 0.35
 EXTENSION = ".txt"
 USE_CPU = False
+BATCH_SIZE = 8
+PREPROCESS_WORKERS = 4
+INTRA_OP_NUM_THREADS = 0  # 0 = let onnxruntime decide
+INTER_OP_NUM_THREADS = 0
+GRAPH_OPTIMIZATION_LEVEL = "all"
+IDLE_UNLOAD_SECS = 30 * 60
 
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Iterator
+
+import numpy as np
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
+from lib.confidences import ConfidenceStore
 from lib.interrogator import Interrogator
 from lib.interrogators import interrogators
 from PIL import Image
@@ -18,6 +30,18 @@ interrogator = interrogators[MODEL]
 if USE_CPU:
     interrogator.use_cpu()
 
+interrogator.configure_session(
+    intra_op_num_threads=INTRA_OP_NUM_THREADS,
+    inter_op_num_threads=INTER_OP_NUM_THREADS,
+    graph_optimization_level=GRAPH_OPTIMIZATION_LEVEL,
+    idle_timeout=IDLE_UNLOAD_SECS,
+)
+
+
+def preload_model():
+    # Load the model ahead of time, so the first import doesn't have to wait for it.
+    interrogator.ensure_loaded()
+
 
 def image_interrogate(image_path: Path):
     """
@@ -26,33 +50,166 @@ def image_interrogate(image_path: Path):
     im = Image.open(image_path)
     result = interrogator.interrogate(im)  # type: ignore
 
+    return postprocess_tags(result[1])
+
+
+def postprocess_tags(tags: dict[str, float], threshold=THRESHOLD) -> dict[str, float]:
     return Interrogator.postprocess_tags(
-        result[1],
-        threshold=THRESHOLD,
+        tags,
+        threshold=threshold,
         escape_tag=True,
         replace_underscore=True,
     )
 
 
-def interrogate_directory(img_dir, output_dir):
-    d = Path(img_dir)
+def preprocess_image(image_path: Path) -> np.ndarray:
+    with Image.open(image_path) as im:
+        return interrogator.preprocess(im)
+
+
+def preprocess_images(
+    image_paths: list[Path], workers=PREPROCESS_WORKERS, max_pending=BATCH_SIZE * 2
+) -> Iterator[tuple[Path, np.ndarray]]:
+    """Preprocess Images.
+
+    Decodes and preprocesses images on a pool of worker threads, so it overlaps with the
+    model. At most max_pending images are queued up ahead of the consumer, which bounds how
+    much memory we use. Yields (image_path, model input) in the same order as image_paths.
+    """
+    paths = iter(image_paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for image_path in paths:
+                pending.append(
+                    (image_path, executor.submit(preprocess_image, image_path))
+                )
+                if len(pending) >= max_pending:
+                    break
+
+            while pending:
+                image_path, future = pending.popleft()
+                next_path = next(paths, None)
+                if next_path is not None:
+                    pending.append(
+                        (next_path, executor.submit(preprocess_image, next_path))
+                    )
+                yield image_path, future.result()
+        finally:
+            # Don't bother finishing the rest if we're stopped early.
+            for _, future in pending:
+                future.cancel()
+
+
+def caption_path_for(image_path: Path, output_dir) -> str:
+    return os.path.join(output_dir, f"{image_path.stem}{EXTENSION}")
+
+
+def needs_interrogating(image_path: Path, caption_path: str) -> bool:
+    # Only if the image has changed since its tags were written.
+    try:
+        return os.path.getmtime(caption_path) < os.path.getmtime(image_path)
+    except FileNotFoundError:
+        return True
+
+
+def images_to_interrogate(img_dir, output_dir, force=False) -> list[Path]:
+    """Images To Interrogate.
+
+    The images in img_dir that interrogate_directory would tag, i.e. those without up to
+    date tags in output_dir (or all of them if force is True).
+    """
+    return [
+        f
+        for f in sorted(Path(img_dir).iterdir())
+        if f.is_file()
+        and f.suffix in [".png", ".jpg", ".jpeg", ".webp"]
+        and (force or needs_interrogating(f, caption_path_for(f, output_dir)))
+    ]
+
+
+def interrogate_directory(
+    img_dir, output_dir, batch_size=BATCH_SIZE, force=False, image_paths=None
+):
+    """Interrogate Directory.
+
+    Writes the tags for each image in img_dir to a .txt file in output_dir. Images that
+    already have up to date tags are skipped, unless force is True. Pass image_paths (from
+    images_to_interrogate) to tag those images instead, i.e. after counting them.
+    """
     os.makedirs(output_dir, exist_ok=True)
+    if image_paths is None:
+        image_paths = images_to_interrogate(img_dir, output_dir, force)
+    if not image_paths:
+        return
+
+    # Keep the raw confidents, so the auto tags can be rederived without the model. Each
+    # batch is logged, and written to the store's header once we're done.
+    store = ConfidenceStore(output_dir)
+
+    # Keep the model loaded until we're done. (The model's input size is also needed to
+    # preprocess the images.)
+    try:
+        with interrogator.in_use():
+            # Run the model on batches of images, which is much faster than one at a time.
+            batch: list[tuple[Path, np.ndarray]] = []
+            for item in preprocess_images(image_paths, max_pending=batch_size * 2):
+                batch.append(item)
+                if len(batch) == batch_size:
+                    yield from _interrogate_batch(batch, output_dir, store)
+                    batch = []
+            if batch:
+                yield from _interrogate_batch(batch, output_dir, store)
+    finally:
+        store.compact()
 
-    for f in d.iterdir():
-        if not f.is_file() or f.suffix not in [".png", ".jpg", ".jpeg", ".webp"]:
-            continue
 
-        image_path = Path(f)
-        caption_path = os.path.join(output_dir, f"{f.stem}{EXTENSION}")
+def _interrogate_batch(
+    batch: list[tuple[Path, np.ndarray]], output_dir, store: ConfidenceStore
+):
+    print("processing:", ", ".join(str(image_path) for image_path, _ in batch))
+    _, confidents = interrogator.predict(
+        np.stack([image_array for _, image_array in batch])
+    )
+
+    store.add(
+        [image_path.stem for image_path, _ in batch],
+        confidents,
+        interrogator.tag_names,
+    )
+
+    for (image_path, _), image_confidents in zip(batch, confidents):
+        tags = interrogator.postprocess_confidents(
+            image_confidents,
+            threshold=THRESHOLD,
+            escape_tag=True,
+            replace_underscore=True,
+        )
+        caption_path = caption_path_for(image_path, output_dir)
+        yield _write_tags(image_path, caption_path, tags)
+
+
+def rederive_auto_tags(output_dir, threshold=THRESHOLD, exclude_tags: list[str] = []):
+    """Rederive Auto Tags.
+
+    Rewrites the auto tags of every image the tagger has seen from the stored confidents,
+    i.e. after changing the threshold, without running the model again.
+    """
+    store = ConfidenceStore(output_dir)
+    for stem, tags in store.above_threshold(threshold, exclude_tags).items():
+        caption_path = os.path.join(output_dir, f"{stem}{EXTENSION}")
+        yield _write_tags(Path(stem), caption_path, postprocess_tags(tags, threshold))
 
-        print("processing:", image_path)
-        tags = image_interrogate(image_path)
 
-        tags_str = ", ".join(tags.keys())
-        with open(caption_path, "w") as fp:
-            fp.write(tags_str)
-            yield {
-                "image_path": str(image_path),
-                "tags": tags_str,
-                "caption_path": caption_path,
-            }
+def _write_tags(image_path: Path, caption_path: str, tags: dict[str, float]):
+    tags_str = ", ".join(tags.keys())
+    # Write to a temp file first, so the project never reads half written tags.
+    tmp_path = f"{caption_path}.tmp"
+    with open(tmp_path, "w") as fp:
+        fp.write(tags_str)
+    os.replace(tmp_path, caption_path)
+    return {
+        "image_path": str(image_path),
+        "tags": tags_str,
+        "caption_path": caption_path,
+    }
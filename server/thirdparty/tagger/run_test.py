@@ -1,7 +1,13 @@
 import os
+import tempfile
 import unittest
+from unittest import mock
 
-from .run import interrogate_directory
+import numpy as np
+
+from .lib.confidences import ConfidenceStore
+from .lib.interrogator import Interrogator, WaifuDiffusionInterrogator
+from .run import interrogate_directory, needs_interrogating
 
 EXPECTED_TAGS = {
     "apple.txt": "fruit, food, no humans, apple, food focus, realistic, still life, black background, cherry, photorealistic, blurry",
@@ -13,26 +19,169 @@ class TestInterrogateDirectory(unittest.TestCase):
 
     def setUp(self):
         self.img_path = os.path.join(os.path.dirname(__file__), "images")
-        self.clean_txt_files()
+        # Written somewhere else, so the test images are left as they are.
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.output_path = self.output_dir.name
 
     def tearDown(self):
-        self.clean_txt_files()
-
-    def clean_txt_files(self):
-        # Remove all the .txt files in the directory
-        for f in os.listdir(self.img_path):
-            if f.endswith(".txt"):
-                os.remove(os.path.join(self.img_path, f))
+        self.output_dir.cleanup()
 
     def test_interrogate_directory(self):
-        for _ in interrogate_directory(self.img_path, self.img_path):
+        for _ in interrogate_directory(self.img_path, self.output_path):
             pass
 
         # Check if the correct .txt files were created.
         for f, tags in EXPECTED_TAGS.items():
-            with open(os.path.join(self.img_path, f), "r") as filen:
+            with open(os.path.join(self.output_path, f), "r") as filen:
                 self.assertEqual(filen.read(), tags)
 
+    def test_needs_interrogating(self):
+        image_path = os.path.join(self.img_path, "apple.png")
+        caption_path = os.path.join(self.output_path, "apple.txt")
+        self.assertTrue(needs_interrogating(image_path, caption_path))
+
+        # Tags written after the image was last modified are up to date.
+        open(caption_path, "w").close()
+        image_mtime = os.path.getmtime(image_path)
+        os.utime(caption_path, (image_mtime + 1, image_mtime + 1))
+        self.assertFalse(needs_interrogating(image_path, caption_path))
+
+        os.utime(caption_path, (image_mtime - 1, image_mtime - 1))
+        self.assertTrue(needs_interrogating(image_path, caption_path))
+
+
+class TestConfidenceStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store = ConfidenceStore(self.temp_dir.name)
+        self.store.add(
+            ["image1", "image2"],
+            np.array([[0.9, 0.1, 0.5], [0.2, 0.8, 0.4]]),
+            ["tag_a", "tag_b", "tag_c"],
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_add(self):
+        store = ConfidenceStore(self.temp_dir.name)
+        store.add(["image3"], np.array([[0.1, 0.1, 0.1]]), store.tag_names)
+
+        # Reopen, to check everything was saved.
+        store = ConfidenceStore(self.temp_dir.name)
+        self.assertEqual(store.num_rows(), 3)
+        self.assertEqual(store.confidents().dtype, np.float16)
+        np.testing.assert_allclose(store.get("image2"), [0.2, 0.8, 0.4], atol=1e-3)
+        self.assertIsNone(store.get("missing"))
+
+    def test_add_different_model(self):
+        self.store.add(["image3"], np.array([[0.7]]), ["other_tag"])
+        self.assertEqual(self.store.rows, {"image3": 0})
+        self.assertEqual(self.store.num_rows(), 1)
+
+    def test_rename_copy_remove(self):
+        self.store.rename("image1", "image1_renamed")
+        self.store.copy("image2", "image2_copy")
+        self.store.remove("image2")
+
+        store = ConfidenceStore(self.temp_dir.name)
+        self.assertEqual(store.rows, {"image1_renamed": 0, "image2_copy": 1})
+
+    def test_compact(self):
+        self.store.remove("image1")
+        self.assertTrue(os.path.exists(self.store.log_path))
+
+        # A half written change (i.e. after a crash) is ignored.
+        with open(self.store.log_path, "a") as fp:
+            fp.write('["remove", "ima')
+
+        self.store.compact()
+        self.assertFalse(os.path.exists(self.store.log_path))
+        store = ConfidenceStore(self.temp_dir.name)
+        self.assertEqual(store.tag_names, ["tag_a", "tag_b", "tag_c"])
+
+        # The unused rows are dropped.
+        self.assertEqual(store.rows, {"image2": 0})
+        self.assertEqual(store.num_rows(), 1)
+        np.testing.assert_allclose(store.get("image2"), [0.2, 0.8, 0.4], atol=1e-3)
+
+        # Nothing is written if nothing was logged.
+        with tempfile.TemporaryDirectory() as empty_dir:
+            ConfidenceStore(empty_dir).compact()
+            self.assertEqual(os.listdir(empty_dir), [])
+
+    def test_compact_interrupted(self):
+        self.store.add(["image1"], np.array([[0.3, 0.3, 0.3]]), self.store.tag_names)
+        self.store.remove("image2")
+
+        # Crash after the new header is written, but before it replaces the old one.
+        replace = os.replace
+        with mock.patch("os.replace") as mock_replace:
+            mock_replace.side_effect = lambda src, dst: (
+                replace(src, dst) if src.endswith(".tmp") else None
+            )
+            self.store.compact()
+
+        # The next load finishes compacting.
+        store = ConfidenceStore(self.temp_dir.name)
+        self.assertEqual(store.rows, {"image1": 0})
+        self.assertEqual(store.num_rows(), 1)
+        np.testing.assert_allclose(store.get("image1"), [0.3, 0.3, 0.3], atol=1e-3)
+        self.assertFalse(os.path.exists(store.log_path))
+
+    def test_no_store(self):
+        # Images in a project that was never auto tagged don't create a store.
+        with tempfile.TemporaryDirectory() as empty_dir:
+            store = ConfidenceStore(empty_dir)
+            store.rename("image1", "image2")
+            store.copy("image2", "image3")
+            store.remove("image3")
+            self.assertEqual(os.listdir(empty_dir), [])
+
+    def test_above_threshold(self):
+        results = self.store.above_threshold(0.45)
+        self.assertEqual(list(results["image1"].keys()), ["tag_a", "tag_c"])
+        self.assertEqual(list(results["image2"].keys()), ["tag_b"])
+
+        results = self.store.above_threshold(0.3, exclude_tags=["tag_a"])
+        self.assertEqual(list(results["image1"].keys()), ["tag_c"])
+        self.assertEqual(list(results["image2"].keys()), ["tag_b", "tag_c"])
+
+
+class TestPostprocessConfidents(unittest.TestCase):
+    def setUp(self):
+        self.interrogator = WaifuDiffusionInterrogator("test", repo_id="test")
+        self.interrogator.tag_names = [
+            "long_hair",
+            "smile",
+            "horror_(theme)",
+            "1girl",
+            "open_mouth",
+            "blue_sky",
+        ]
+        self.confidents = np.array([0.9, 0.2, 0.5, 0.9, 0.36, 0.35], dtype=np.float32)
+
+    def assert_same_as_postprocess_tags(self, **kwargs):
+        tags = dict(zip(self.interrogator.tag_names, self.confidents.tolist()))
+        expected = Interrogator.postprocess_tags(tags, **kwargs)
+        results = self.interrogator.postprocess_confidents(self.confidents, **kwargs)
+        self.assertEqual(list(results.items()), list(expected.items()))
+
+    def test_same_as_postprocess_tags(self):
+        self.assert_same_as_postprocess_tags()
+        self.assert_same_as_postprocess_tags(threshold=0.5)
+        self.assert_same_as_postprocess_tags(escape_tag=True, replace_underscore=True)
+        self.assert_same_as_postprocess_tags(
+            replace_underscore=True, replace_underscore_excludes=["blue_sky"]
+        )
+        self.assert_same_as_postprocess_tags(exclude_tags=["1girl", "smile"])
+        self.assert_same_as_postprocess_tags(sort_by_alphabetical_order=True)
+        self.assert_same_as_postprocess_tags(add_confident_as_weight=True)
+
+    def test_top_k(self):
+        results = self.interrogator.postprocess_confidents(self.confidents, top_k=3)
+        self.assertEqual(list(results.keys()), ["long_hair", "1girl", "horror_(theme)"])
+
 
 if __name__ == "__main__":
     unittest.main()
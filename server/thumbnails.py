@@ -0,0 +1,78 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from consts import THUMBNAIL_WIDTH, THUMBNAIL_WORKERS
+from PIL import Image
+
+# Thumbnails are generated in the background after imports and edits, so they're usually
+# ready by the time the UI asks for them.
+_executor = ThreadPoolExecutor(
+    max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails"
+)
+_pending: set[Future] = set()
+_pending_lock = threading.Lock()
+
+
+def is_fresh(img_path: Path, thumb_path: Path) -> bool:
+    # The thumbnail is up to date if it was written after the image was last modified.
+    try:
+        return os.stat(thumb_path).st_mtime_ns >= os.stat(img_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def make_thumbnail(img_path: Path, thumbs_dir: Path) -> Path:
+    """Make Thumbnail.
+
+    Returns the path to the image's thumbnail, generating it first if it's missing or
+    older than the image.
+    """
+    thumb_path = thumbs_dir.joinpath(img_path.name)
+    if is_fresh(img_path, thumb_path):
+        return thumb_path
+
+    os.makedirs(thumbs_dir, exist_ok=True)
+    with Image.open(img_path) as img:
+        img.thumbnail((THUMBNAIL_WIDTH, int(THUMBNAIL_WIDTH * img.height / img.width)))
+
+        # Write to a temp file first, so we never serve a half-written thumbnail.
+        tmp_path = thumbs_dir.joinpath(f".{img_path.name}.{threading.get_ident()}.tmp")
+        img.save(tmp_path, "PNG")
+    os.replace(tmp_path, thumb_path)
+    return thumb_path
+
+
+def make_thumbnails_in_background(img_paths: list[Path], thumbs_dir: Path):
+    for img_path in img_paths:
+        future = _executor.submit(_make_thumbnail_quietly, img_path, thumbs_dir)
+        with _pending_lock:
+            _pending.add(future)
+        future.add_done_callback(_discard_pending)
+
+
+def delete_thumbnail(fname: str, thumbs_dir: Path):
+    thumb_path = thumbs_dir.joinpath(fname)
+    if os.path.exists(thumb_path):
+        os.remove(thumb_path)
+
+
+def wait_for_thumbnails():
+    # Block until all the background thumbnails have been generated.
+    with _pending_lock:
+        pending = list(_pending)
+    wait(pending)
+
+
+def _make_thumbnail_quietly(img_path: Path, thumbs_dir: Path):
+    try:
+        make_thumbnail(img_path, thumbs_dir)
+    except Exception as e:
+        # Not fatal, we'll try again when the thumbnail is requested.
+        print(f"Failed to make thumbnail for {img_path}: {e}")
+
+
+def _discard_pending(future: Future):
+    with _pending_lock:
+        _pending.discard(future)
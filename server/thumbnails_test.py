@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from PIL import Image
+from thumbnails import (
+    delete_thumbnail,
+    make_thumbnail,
+    make_thumbnails_in_background,
+    wait_for_thumbnails,
+)
+
+
+class TestThumbnails(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.temp_dir_path = Path(self.temp_dir.name)
+        self.thumbs_dir = self.temp_dir_path.joinpath(".thumbs")
+
+        self.img_path = self.temp_dir_path.joinpath("test.png")
+        Image.new("RGB", (1000, 500), color="red").save(self.img_path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_make_thumbnail(self):
+        thumb_path = make_thumbnail(self.img_path, self.thumbs_dir)
+        self.assertEqual(thumb_path, self.thumbs_dir.joinpath("test.png"))
+        with Image.open(thumb_path) as thumb:
+            self.assertEqual(thumb.size, (250, 125))
+
+    def test_reuses_fresh_thumbnail(self):
+        thumb_path = make_thumbnail(self.img_path, self.thumbs_dir)
+        mtime = os.stat(thumb_path).st_mtime_ns
+        make_thumbnail(self.img_path, self.thumbs_dir)
+        self.assertEqual(os.stat(thumb_path).st_mtime_ns, mtime)
+
+    def test_regenerates_stale_thumbnail(self):
+        thumb_path = make_thumbnail(self.img_path, self.thumbs_dir)
+
+        # Replace the image with a newer one.
+        Image.new("RGB", (500, 500), color="blue").save(self.img_path)
+        mtime = os.stat(thumb_path).st_mtime_ns + 1_000_000_000
+        os.utime(self.img_path, ns=(mtime, mtime))
+
+        make_thumbnail(self.img_path, self.thumbs_dir)
+        with Image.open(thumb_path) as thumb:
+            self.assertEqual(thumb.size, (250, 250))
+
+    def test_make_thumbnails_in_background(self):
+        make_thumbnails_in_background([self.img_path], self.thumbs_dir)
+        wait_for_thumbnails()
+        self.assertTrue(os.path.exists(self.thumbs_dir.joinpath("test.png")))
+        self.assertEqual(os.listdir(self.thumbs_dir), ["test.png"])
+
+    def test_delete_thumbnail(self):
+        thumb_path = make_thumbnail(self.img_path, self.thumbs_dir)
+        delete_thumbnail("test.png", self.thumbs_dir)
+        self.assertFalse(os.path.exists(thumb_path))
+
+        # Deleting a missing thumbnail is fine.
+        delete_thumbnail("test.png", self.thumbs_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()